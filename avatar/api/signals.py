@@ -2,21 +2,29 @@ import os
 
 from avatar.api.shortcut import get_object_or_none
 from avatar.conf import settings
-from avatar.models import Avatar, invalidate_avatar_cache
+from avatar.models import (
+    Avatar,
+    invalidate_avatar_cache,
+    normalize_sizes,
+    thumbnail_formats,
+)
+from avatar.utils import get_thumbnail_task_backend
 
 
 def create_default_thumbnails(sender, instance, created=False, **kwargs):
     invalidate_avatar_cache(sender, instance)
 
     if not created:
-        for size in settings.AVATAR_AUTO_GENERATE_SIZES:
-            if isinstance(size, int):
-                if not instance.thumbnail_exists(size, size):
-                    instance.create_thumbnail(size, size)
-            else:
-                # Size is specified with height and width.
-                if not instance.thumbnail_exists(size[0, size[0]]):
-                    instance.create_thumbnail(size[0], size[1])
+        missing_sizes = [
+            size
+            for size in normalize_sizes(settings.AVATAR_AUTO_GENERATE_SIZES)
+            if not all(
+                instance.thumbnail_exists(*size, format=format)
+                for format in thumbnail_formats()
+            )
+        ]
+        if missing_sizes:
+            get_thumbnail_task_backend().enqueue(instance, missing_sizes)
 
 
 def remove_previous_avatar_images_when_update(
@@ -29,6 +37,7 @@ def remove_previous_avatar_images_when_update(
             path, filename = os.path.split(base_filepath)
             # iterate through resized avatars directories and delete resized avatars
             resized_path = os.path.join(path, "resized")
+            instance.forget_thumbnails()
             try:
                 resized_widths, _ = old_instance.avatar.storage.listdir(resized_path)
                 for width in resized_widths:
@@ -37,10 +46,10 @@ def remove_previous_avatar_images_when_update(
                         resized_width_path
                     )
                     for height in resized_heights:
-                        if old_instance.thumbnail_exists(width, height):
-                            old_instance.avatar.storage.delete(
-                                old_instance.avatar_name(width, height)
-                            )
+                        for format in thumbnail_formats():
+                            thumb_name = old_instance.avatar_name(width, height, format)
+                            if old_instance.avatar.storage.exists(thumb_name):
+                                old_instance.avatar.storage.delete(thumb_name)
                 if update_main_avatar:
                     if old_instance.avatar.storage.exists(old_instance.avatar.name):
                         old_instance.avatar.storage.delete(old_instance.avatar.name)
@@ -9,7 +9,12 @@ from avatar.api.serializers import AvatarSerializer
 from avatar.api.utils import HTMLTagParser, assign_width_or_height, set_new_primary
 from avatar.models import Avatar
 from avatar.templatetags.avatar_tags import avatar
-from avatar.utils import get_default_avatar_url, get_primary_avatar, invalidate_cache
+from avatar.utils import (
+    get_allowed_size,
+    get_default_avatar_url,
+    get_primary_avatar,
+    invalidate_cache,
+)
 
 
 class AvatarViewSets(viewsets.ModelViewSet):
@@ -115,8 +120,12 @@ class AvatarViewSets(viewsets.ModelViewSet):
         context_data = {}
         avatar_size = assign_width_or_height(request.query_params)
 
-        width = avatar_size.get("width")
-        height = avatar_size.get("height")
+        try:
+            width, height = get_allowed_size(
+                avatar_size.get("width"), avatar_size.get("height")
+            )
+        except ValueError as e:
+            raise ValidationError(str(e))
 
         primary_avatar = get_primary_avatar(request.user, width=width, height=height)
 
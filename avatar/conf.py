@@ -6,31 +6,63 @@ from PIL import Image
 class AvatarConf(AppConf):
     DEFAULT_SIZE = 80
     RESIZE_METHOD = Image.Resampling.LANCZOS
+    RESIZE_REDUCING_GAP = 3.0
+    IMAGE_BACKEND = "avatar.imaging.PillowBackend"
+    PLACEHOLDER_SIZE = 8
+    PLACEHOLDER_FORMAT = "WEBP"
     STORAGE_DIR = "avatars"
     PATH_HANDLER = "avatar.models.avatar_path_handler"
     GRAVATAR_BASE_URL = "https://www.gravatar.com/avatar/"
     GRAVATAR_FIELD = "email"
+    LIBRAVATAR_DNS_TIMEOUT = 1.0
+    LIBRAVATAR_DNS_LIFETIME = 2.0
+    LIBRAVATAR_NEGATIVE_CACHE_TIMEOUT = 60 * 5
     GRAVATAR_DEFAULT = None
     AVATAR_GRAVATAR_FORCEDEFAULT = False
     DEFAULT_URL = "avatar/img/default.jpg"
     MAX_AVATARS_PER_USER = 42
+    PRIMARY_AVATAR_FIELD = None
     MAX_SIZE = 1024 * 1024
+    MAX_PIXELS = None
+    NORMALIZE_ORIGINALS = False
+    MAX_ORIGINAL_DIMENSION = 1024
+    ORIGINAL_FORMAT = "JPEG"
+    ORIGINAL_QUALITY = 90
     THUMB_FORMAT = "PNG"
+    THUMB_EXTRA_FORMATS = ()
     THUMB_QUALITY = 85
     THUMB_MODES = ("RGB", "RGBA")
+    THUMBNAIL_STORAGE_FALLBACK = True
     HASH_FILENAMES = False
     HASH_USERDIRNAMES = False
     EXPOSE_USERNAMES = False
     ALLOWED_FILE_EXTS = None
     ALLOWED_MIMETYPES = None
     CACHE_TIMEOUT = 60 * 60
+    CACHE_VERSIONED_KEYS = True
+    LOCAL_CACHE_SIZE = 0
+    LOCAL_CACHE_TIMEOUT = 5
     if hasattr(settings, "DEFAULT_FILE_STORAGE"):
         STORAGE = settings.DEFAULT_FILE_STORAGE  # deprecated settings
     STORAGE_ALIAS = "default"
     CLEANUP_DELETED = True
     AUTO_GENERATE_SIZES = (DEFAULT_SIZE,)
+    ALLOWED_SIZES = None
+    SIZE_POLICY = "snap"
     FACEBOOK_GET_ID = None
     CACHE_ENABLED = True
+    THUMBNAIL_TASK_BACKEND = "avatar.tasks.SynchronousBackend"
+    THUMBNAIL_TASK_WORKERS = 2
+    PENDING_USE_ORIGINAL = True
+    THUMBNAIL_LOCK_TIMEOUT = 30
+    THUMBNAIL_LOCK_WAIT = 2.0
+    RENDER_PRIMARY_MODE = "redirect"
+    RENDER_PRIMARY_MAX_AGE = 60 * 60
+    SENDFILE_BACKEND = None
+    SENDFILE_URL_PREFIX = "/protected/avatars/"
+    SPRITE_MAX_USERS = 200
+    SPRITE_MAX_SIZE = 128
+    FAST_TAG_RENDERING = True
     RANDOMIZE_HASHES = False
     ADD_TEMPLATE = ""
     CHANGE_TEMPLATE = ""
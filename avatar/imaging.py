@@ -0,0 +1,281 @@
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+from avatar.conf import settings
+
+EXIF_ORIENTATION = 0x0112
+
+# Formats taking an encoding quality, the others are lossless
+LOSSY_FORMATS = ("JPEG", "WEBP", "AVIF")
+
+# Placeholders are blurry by design, keep them as small as possible
+PLACEHOLDER_QUALITY = 30
+
+
+class ImageBackend(object):
+    """
+    Base class of the image backends configured by ``AVATAR_IMAGE_BACKEND``.
+
+    Subclasses implement the ``open``, ``orient``, ``size``, ``crop``,
+    ``resize`` and ``encode`` primitives, or override ``create_thumbnails``
+    altogether.
+    """
+
+    def open(self, file, sizes):
+        """
+        Returns the image read from ``file`` and whether it was scaled down
+        while being decoded, which may happen when it is larger than needed
+        for the given sizes. Raises ``IOError`` if ``file`` is not an image.
+        """
+        raise NotImplementedError
+
+    def orient(self, image):
+        """Returns the image rotated according to its EXIF orientation."""
+        raise NotImplementedError
+
+    def size(self, image):
+        raise NotImplementedError
+
+    def crop(self, image, width, height):
+        """Returns the center of the image with the wanted aspect ratio."""
+        raise NotImplementedError
+
+    def resize(self, image, width, height):
+        raise NotImplementedError
+
+    def encode(self, image, format, quality):
+        """Returns the bytes of the image saved in the given format."""
+        raise NotImplementedError
+
+    def placeholder(self, image):
+        """
+        Returns the bytes of a tiny version of the image, of
+        ``AVATAR_PLACEHOLDER_SIZE`` pixels square, in
+        ``AVATAR_PLACEHOLDER_FORMAT``.
+        """
+        size = settings.AVATAR_PLACEHOLDER_SIZE
+        image = self.resize(self.crop(image, size, size), size, size)
+        return self.encode(
+            image, settings.AVATAR_PLACEHOLDER_FORMAT, PLACEHOLDER_QUALITY
+        )
+
+    def create_placeholder(self, file):
+        """
+        Returns the placeholder of the image in ``file``, see ``placeholder``.
+        Raises ``IOError`` if ``file`` is not an image.
+        """
+        size = settings.AVATAR_PLACEHOLDER_SIZE
+        image, _ = self.open(file, [(size, size)])
+        return self.placeholder(self.orient(image))
+
+    def create_thumbnails(self, file, sizes, formats, quality, placeholder=False):
+        """
+        Returns a list of ``(width, height, format, data)`` tuples for each of
+        the ``sizes`` in each of the ``formats``, decoding ``file`` only once,
+        and the placeholder of the image if asked for (``None`` otherwise).
+        Raises ``IOError`` if ``file`` is not an image.
+        """
+        image, reduced = self.open(file, sizes)
+        image = self.orient(image)
+        thumbnails = []
+        # The smallest image at hand once the thumbnails are done
+        smallest = image
+        for width, height in sizes:
+            keep_original = not reduced and self.size(image) == (width, height)
+            resized = None
+            for format in formats:
+                if keep_original and format == settings.AVATAR_THUMB_FORMAT:
+                    file.seek(0)
+                    data = file.read()
+                else:
+                    if resized is None:
+                        resized = self.resize(
+                            self.crop(image, width, height), width, height
+                        )
+                        smallest = resized
+                    data = self.encode(resized, format, quality)
+                thumbnails.append((width, height, format, data))
+        return thumbnails, self.placeholder(smallest) if placeholder else None
+
+
+class PillowBackend(ImageBackend):
+    """
+    Processes images with Pillow, letting JPEG images be scaled down while
+    they are decoded (see ``AVATAR_RESIZE_REDUCING_GAP``).
+    """
+
+    def open(self, file, sizes):
+        image = Image.open(file)
+        return image, self.draft(image, sizes)
+
+    def draft(self, image, sizes):
+        """
+        Lets the decoder shrink the image while loading it (JPEG DCT scaling),
+        keeping at least ``AVATAR_RESIZE_REDUCING_GAP`` times the pixels needed
+        for the largest of the given sizes. Returns whether the image got
+        scaled down.
+        """
+        reducing_gap = settings.AVATAR_RESIZE_REDUCING_GAP
+        if not reducing_gap:
+            return False
+        original_size = w, h = image.size
+        rotated = image.getexif().get(EXIF_ORIENTATION, 1) in (5, 6, 7, 8)
+        if rotated:
+            w, h = h, w
+        draft_w = draft_h = 1
+        for width, height in sizes:
+            # Only the center crop with the wanted aspect ratio is resized
+            crop_w = min(w, h * width / height)
+            crop_h = min(h, w * height / width)
+            scale = max(width / crop_w, height / crop_h) * reducing_gap
+            draft_w = max(draft_w, int(w * scale))
+            draft_h = max(draft_h, int(h * scale))
+        if rotated:
+            draft_w, draft_h = draft_h, draft_w
+        image.draft(None, (draft_w, draft_h))
+        return image.size != original_size
+
+    def orient(self, image):
+        exif_code = image.getexif().get(EXIF_ORIENTATION, 1)
+        if exif_code and exif_code != 1:
+            image = ImageOps.exif_transpose(image)
+        return image
+
+    def size(self, image):
+        return image.size
+
+    def crop(self, image, width, height):
+        w, h = image.size
+        ratioReal = 1.0 * w / h
+        ratioWant = 1.0 * width / height
+        if ratioReal > ratioWant:
+            diff = int((w - (h * ratioWant)) / 2)
+            image = image.crop((diff, 0, w - diff, h))
+        elif ratioReal < ratioWant:
+            diff = int((h - (w / ratioWant)) / 2)
+            image = image.crop((0, diff, w, h - diff))
+        return image
+
+    def resize(self, image, width, height):
+        if image.mode not in (settings.AVATAR_THUMB_MODES):
+            image = image.convert(settings.AVATAR_THUMB_MODES[0])
+        return image.resize(
+            (width, height),
+            settings.AVATAR_RESIZE_METHOD,
+            reducing_gap=settings.AVATAR_RESIZE_REDUCING_GAP,
+        )
+
+    def encode(self, image, format, quality):
+        if format == "JPEG" and image.mode == "RGBA":
+            image = image.convert("RGB")
+        thumb = BytesIO()
+        image.save(thumb, format, quality=quality)
+        return thumb.getvalue()
+
+
+class VipsBackend(ImageBackend):
+    """
+    Processes images with libvips, through pyvips. The original is decoded
+    once by the libvips thumbnailer, which shrinks JPEG, WebP and other
+    images while loading them, to the largest of the thumbnail sizes.
+    """
+
+    def __init__(self):
+        try:
+            import pyvips
+        except ImportError:
+            raise ImportError(
+                "pyvips library must be installed in order to use the libvips image backend"
+            )
+        self.pyvips = pyvips
+
+    def open(self, file, sizes):
+        data = file.read()
+        try:
+            # Only reads the header, pixels are decoded on demand
+            image = self.pyvips.Image.new_from_buffer(data, "")
+        except self.pyvips.Error as e:
+            raise IOError(str(e))
+        return image, False
+
+    def orient(self, image):
+        return image.autorot()
+
+    def size(self, image):
+        return image.width, image.height
+
+    def crop(self, image, width, height):
+        return image.smartcrop(
+            min(image.width, round(image.height * width / height)),
+            min(image.height, round(image.width * height / width)),
+            interesting="centre",
+        )
+
+    def resize(self, image, width, height):
+        return image.thumbnail_image(width, height=height, size="force")
+
+    def encode(self, image, format, quality):
+        from avatar.models import find_extension
+
+        if image.interpretation not in ("srgb", "b-w"):
+            image = image.colourspace("srgb")
+        if format == "JPEG" and image.hasalpha():
+            image = image.flatten()
+        options = {"Q": quality} if format in LOSSY_FORMATS else {}
+        return image.write_to_buffer("." + find_extension(format), **options)
+
+    def create_placeholder(self, file):
+        size = settings.AVATAR_PLACEHOLDER_SIZE
+        try:
+            image = self.pyvips.Image.thumbnail_buffer(
+                file.read(), size, height=size, crop="centre"
+            )
+        except self.pyvips.Error as e:
+            raise IOError(str(e))
+        return self.encode(
+            image, settings.AVATAR_PLACEHOLDER_FORMAT, PLACEHOLDER_QUALITY
+        )
+
+    def create_thumbnails(self, file, sizes, formats, quality, placeholder=False):
+        data = file.read()
+        image, _ = self.open(BytesIO(data), sizes)
+        # Swapped width and height for the EXIF orientations rotating by 90°
+        size = self.size(image)
+        if image.get_typeof("orientation") and image.get("orientation") in (5, 6, 7, 8):
+            size = size[::-1]
+        # A single shrink-on-load pass to the largest needed size, the
+        # thumbnails are then cropped and resized from it in memory.
+        w, h = size
+        scale = min(1, max(max(width / w, height / h) for width, height in sizes))
+        base = smallest = None
+
+        def get_base():
+            return self.pyvips.Image.thumbnail_buffer(
+                data,
+                max(1, round(w * scale)),
+                height=max(1, round(h * scale)),
+                size="down",
+            ).copy_memory()
+
+        thumbnails = []
+        for width, height in sizes:
+            keep_original = size == (width, height)
+            resized = None
+            for format in formats:
+                if keep_original and format == settings.AVATAR_THUMB_FORMAT:
+                    thumbnails.append((width, height, format, data))
+                    continue
+                if base is None:
+                    base = get_base()
+                if resized is None:
+                    resized = self.resize(self.crop(base, width, height), width, height)
+                    smallest = resized
+                thumbnails.append(
+                    (width, height, format, self.encode(resized, format, quality))
+                )
+        if not placeholder:
+            return thumbnails, None
+        if smallest is None:
+            smallest = get_base()
+        return thumbnails, self.placeholder(smallest)
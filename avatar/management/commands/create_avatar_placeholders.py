@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from avatar.models import Avatar
+
+
+class Command(BaseCommand):
+    help = "Generates the placeholders of avatars which don't have one yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Regenerate the placeholders of all the avatars.",
+        )
+
+    def handle(self, *args, **options):
+        avatars = Avatar.objects.select_related("user").order_by("pk")
+        if not options["all"]:
+            avatars = avatars.filter(placeholder="")
+        for avatar in avatars.iterator():
+            created = avatar.create_placeholder()
+            if options["verbosity"] != 0:
+                if created:
+                    message = "Created placeholder for Avatar id=%s."
+                else:
+                    message = "Could not create placeholder for Avatar id=%s."
+                self.stdout.write(message % avatar.id)
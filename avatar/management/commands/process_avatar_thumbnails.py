@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from avatar.tasks import DatabaseBackend
+
+
+class Command(BaseCommand):
+    help = "Generates the avatar thumbnails queued by avatar.tasks.DatabaseBackend."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Number of queued avatars claimed at once.",
+        )
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep waiting for new thumbnails instead of exiting.",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=1.0,
+            help="Seconds to wait for new thumbnails when the queue is empty.",
+        )
+
+    def handle(self, *args, **options):
+        backend = DatabaseBackend()
+        while True:
+            processed = backend.process(limit=options["batch_size"])
+            if processed and options["verbosity"] != 0:
+                self.stdout.write("Generated thumbnails for %s avatars." % processed)
+            if processed:
+                continue
+            if not options["loop"]:
+                break
+            time.sleep(options["sleep"])
@@ -1,7 +1,61 @@
-from django.core.management.base import BaseCommand
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import is_naive, make_aware
 
 from avatar.conf import settings
-from avatar.models import Avatar, remove_avatar_images
+
+# The models are imported inside the functions below, worker processes have
+# to unpickle them before init_worker() gets to set up Django.
+
+
+def init_worker():
+    import django
+
+    django.setup()
+
+
+def rebuild_chunk(ids, only_missing=False):
+    from avatar.models import (
+        Avatar,
+        normalize_sizes,
+        remove_avatar_images,
+        thumbnail_formats,
+    )
+
+    sizes = normalize_sizes(settings.AVATAR_AUTO_GENERATE_SIZES)
+    formats = thumbnail_formats()
+    avatars = Avatar.objects.filter(pk__in=ids).select_related("user")
+    for avatar in avatars:
+        if only_missing:
+            missing_sizes = [
+                size
+                for size in sizes
+                if not all(
+                    avatar.thumbnail_exists(*size, format=format) for format in formats
+                )
+            ]
+            avatar.create_thumbnails(missing_sizes)
+        else:
+            if settings.AVATAR_CLEANUP_DELETED:
+                remove_avatar_images(avatar, delete_main_avatar=False)
+            avatar.create_thumbnails(sizes)
+    return len(ids)
+
+
+def parse_since(value):
+    try:
+        since = datetime.fromisoformat(value)
+    except ValueError:
+        raise CommandError("--since expects an ISO 8601 date, got %r." % value)
+    if settings.USE_TZ and is_naive(since):
+        since = make_aware(since)
+    return since
 
 
 class Command(BaseCommand):
@@ -10,17 +64,118 @@ class Command(BaseCommand):
         "settings.AVATAR_AUTO_GENERATE_SIZES."
     )
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of processes rebuilding avatars in parallel.",
+        )
+        parser.add_argument(
+            "--only-missing",
+            action="store_true",
+            help="Only create thumbnails that don't exist yet.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=500,
+            help="Number of avatars fetched and handed to a worker at once.",
+        )
+        parser.add_argument(
+            "--since",
+            help="Only rebuild avatars uploaded at or after this ISO 8601 date.",
+        )
+        parser.add_argument(
+            "--id-range",
+            nargs=2,
+            type=int,
+            metavar=("FIRST", "LAST"),
+            help="Only rebuild avatars whose id is within this inclusive range.",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            help=(
+                "File recording the last rebuilt avatar id. An interrupted "
+                "run started again with the same file resumes after that id, "
+                "the file is removed once the run completes."
+            ),
+        )
+
     def handle(self, *args, **options):
-        for avatar in Avatar.objects.all():
-            if settings.AVATAR_CLEANUP_DELETED:
-                remove_avatar_images(avatar, delete_main_avatar=False)
-            for size in settings.AVATAR_AUTO_GENERATE_SIZES:
-                if options["verbosity"] != 0:
-                    self.stdout.write(
-                        "Rebuilding Avatar id=%s at size %s." % (avatar.id, size)
+        from avatar.models import Avatar
+
+        avatars = Avatar.objects.order_by("pk")
+        if options["since"]:
+            avatars = avatars.filter(date_uploaded__gte=parse_since(options["since"]))
+        if options["id_range"]:
+            avatars = avatars.filter(pk__range=options["id_range"])
+        checkpoint = options["checkpoint"]
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                last_id = int(f.read().strip() or 0)
+            avatars = avatars.filter(pk__gt=last_id)
+            if options["verbosity"] != 0:
+                self.stdout.write("Resuming after Avatar id=%s." % last_id)
+
+        chunk_size = options["chunk_size"]
+        ids = avatars.values_list("pk", flat=True).iterator(chunk_size=chunk_size)
+        chunks = self.chunked(ids, chunk_size)
+        only_missing = options["only_missing"]
+        workers = options["workers"]
+
+        self.rebuilt = 0
+        self.started = time.monotonic()
+        if workers > 1:
+            # Spawn fresh interpreters rather than forking, so the workers
+            # don't inherit the database connection iterating over the ids.
+            with ProcessPoolExecutor(
+                workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker,
+            ) as executor:
+                # Keep a bounded number of chunks in flight and collect them
+                # in order, so the checkpoint never skips unfinished work.
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(
+                        (chunk, executor.submit(rebuild_chunk, chunk, only_missing))
                     )
-                if isinstance(size, int):
-                    avatar.create_thumbnail(size, size)
-                else:
-                    # Size is specified with height and width.
-                    avatar.create_thumbnail(size[0], size[1])
+                    if len(pending) >= workers * 2:
+                        self.chunk_done(*pending.popleft(), options)
+                while pending:
+                    self.chunk_done(*pending.popleft(), options)
+        else:
+            for chunk in chunks:
+                rebuild_chunk(chunk, only_missing)
+                self.chunk_done(chunk, None, options)
+
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+    def chunked(self, ids, chunk_size):
+        chunk = []
+        for pk in ids:
+            chunk.append(pk)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def chunk_done(self, chunk, future, options):
+        if future is not None:
+            future.result()
+        self.rebuilt += len(chunk)
+        if options["checkpoint"]:
+            with open(options["checkpoint"], "w") as f:
+                f.write(str(chunk[-1]))
+        if options["verbosity"] != 0:
+            self.stdout.write(
+                "Rebuilt %s avatars, up to id=%s (%s)."
+                % (self.rebuilt, chunk[-1], self.rate())
+            )
+
+    def rate(self):
+        elapsed = time.monotonic() - self.started
+        return "%.1f avatars/s" % (self.rebuilt / elapsed if elapsed else 0)
@@ -0,0 +1,68 @@
+import hashlib
+import os
+
+from django.core.management.base import BaseCommand
+from PIL import Image
+
+from avatar.models import Avatar
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuilds the database manifest of avatar thumbnails from the files "
+        "found in the storage."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--checksums",
+            action="store_true",
+            help="Read every thumbnail to record its checksum.",
+        )
+
+    def handle(self, *args, **options):
+        extensions = Image.registered_extensions()
+        avatars = Avatar.objects.select_related("user").order_by("pk")
+        for avatar in avatars.iterator():
+            storage = avatar.avatar.storage
+            path, filename = os.path.split(avatar.avatar.name)
+            root = os.path.splitext(filename)[0]
+            resized_path = os.path.join(path, "resized")
+            thumbnails = []
+            try:
+                resized_widths, _ = storage.listdir(resized_path)
+            except FileNotFoundError:
+                resized_widths = []
+            for width in resized_widths:
+                resized_width_path = os.path.join(resized_path, width)
+                resized_heights, _ = storage.listdir(resized_width_path)
+                for height in resized_heights:
+                    resized_height_path = os.path.join(resized_width_path, height)
+                    _, files = storage.listdir(resized_height_path)
+                    for name in files:
+                        # Thumbnails of all the avatars of a user share the
+                        # same directories.
+                        name_root, ext = os.path.splitext(name)
+                        if name_root != root or ext.lower() not in extensions:
+                            continue
+                        thumb_name = os.path.join(resized_height_path, name)
+                        checksum = ""
+                        if options["checksums"]:
+                            with storage.open(thumb_name, "rb") as f:
+                                checksum = hashlib.md5(f.read()).hexdigest()
+                        thumbnails.append(
+                            (
+                                int(width),
+                                int(height),
+                                extensions[ext.lower()],
+                                storage.size(thumb_name),
+                                checksum,
+                            )
+                        )
+            avatar.forget_thumbnails()
+            avatar.record_thumbnails(thumbnails)
+            if options["verbosity"] != 0:
+                self.stdout.write(
+                    "Recorded %s thumbnails for Avatar id=%s."
+                    % (len(thumbnails), avatar.id)
+                )
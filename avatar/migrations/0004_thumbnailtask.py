@@ -0,0 +1,46 @@
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("avatar", "0003_auto_20170827_1345"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ThumbnailTask",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("sizes", models.JSONField(verbose_name="sizes")),
+                (
+                    "date_created",
+                    models.DateTimeField(
+                        default=django.utils.timezone.now, verbose_name="created at"
+                    ),
+                ),
+                (
+                    "avatar",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="thumbnail_tasks",
+                        to="avatar.avatar",
+                        verbose_name="avatar",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "thumbnail task",
+                "verbose_name_plural": "thumbnail tasks",
+            },
+        ),
+    ]
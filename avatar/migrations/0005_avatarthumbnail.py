@@ -0,0 +1,61 @@
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("avatar", "0004_thumbnailtask"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AvatarThumbnail",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("width", models.PositiveIntegerField(verbose_name="width")),
+                ("height", models.PositiveIntegerField(verbose_name="height")),
+                ("format", models.CharField(max_length=16, verbose_name="format")),
+                ("size", models.PositiveIntegerField(null=True, verbose_name="size")),
+                (
+                    "checksum",
+                    models.CharField(
+                        blank=True, max_length=32, verbose_name="checksum"
+                    ),
+                ),
+                (
+                    "date_created",
+                    models.DateTimeField(
+                        default=django.utils.timezone.now, verbose_name="created at"
+                    ),
+                ),
+                (
+                    "avatar",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="thumbnails",
+                        to="avatar.avatar",
+                        verbose_name="avatar",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "avatar thumbnail",
+                "verbose_name_plural": "avatar thumbnails",
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("avatar", "width", "height", "format"),
+                        name="avatar_thumbnail_unique_rendition",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("avatar", "0005_avatarthumbnail"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="avatar",
+            name="placeholder",
+            field=models.TextField(
+                blank=True, editable=False, verbose_name="placeholder"
+            ),
+        ),
+    ]
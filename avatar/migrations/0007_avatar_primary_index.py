@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.db import migrations, models
+
+
+def keep_latest_primary(apps, schema_editor):
+    """Leaves a single primary avatar per user, the most recent one."""
+    Avatar = apps.get_model("avatar", "Avatar")
+    users = set()
+    demoted = []
+    avatars = (
+        Avatar.objects.filter(primary=True)
+        .order_by("user", "-date_uploaded", "-pk")
+        .values_list("pk", "user")
+    )
+    for pk, user in avatars.iterator():
+        if user in users:
+            demoted.append(pk)
+        users.add(user)
+    Avatar.objects.filter(pk__in=demoted).update(primary=False)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("avatar", "0006_avatar_placeholder"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="avatar",
+            index=models.Index(
+                fields=["user", "-primary", "-date_uploaded"],
+                name="avatar_user_primary_idx",
+            ),
+        ),
+        migrations.RunPython(keep_latest_primary, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="avatar",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("primary", True)),
+                fields=("user",),
+                name="avatar_one_primary_per_user",
+            ),
+        ),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("avatar", "0007_avatar_primary_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="thumbnailtask",
+            name="date_claimed",
+            field=models.DateTimeField(
+                blank=True, null=True, verbose_name="claimed at"
+            ),
+        ),
+        migrations.AddField(
+            model_name="thumbnailtask",
+            name="error",
+            field=models.TextField(blank=True, verbose_name="error"),
+        ),
+    ]
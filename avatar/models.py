@@ -1,21 +1,31 @@
+import base64
 import binascii
 import hashlib
 import os
 from contextlib import closing
 from io import BytesIO
 
-from django.core.files import File
 from django.core.files.base import ContentFile
-from django.db import models
-from django.db.models import signals
+from django.db import connection, models, transaction
+from django.db.models import Q, signals
+from django.db.models.fields.files import ImageFieldFile
 from django.utils.encoding import force_bytes, force_str
+from django.utils.functional import cached_property
 from django.utils.module_loading import import_string
 from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
-from PIL import Image, ImageOps
+from PIL import Image, ImageCms, ImageOps
 
 from avatar.conf import settings
-from avatar.utils import get_username, invalidate_cache
+from avatar.imaging import PillowBackend
+from avatar.utils import (
+    get_image_backend,
+    get_thumbnail_task_backend,
+    get_username,
+    invalidate_cache,
+    normalize_sizes,
+    snap_size,
+)
 
 try:  # Django 4.2+
     from django.core.files.storage import storages
@@ -65,6 +75,23 @@ def avatar_path_handler(
 avatar_file_path = import_string(settings.AVATAR_PATH_HANDLER)
 
 
+def thumbnail_formats():
+    """
+    Returns the formats thumbnails are generated in: ``AVATAR_THUMB_FORMAT``
+    followed by ``AVATAR_THUMB_EXTRA_FORMATS``.
+    """
+    formats = [settings.AVATAR_THUMB_FORMAT]
+    for format in settings.AVATAR_THUMB_EXTRA_FORMATS:
+        if format not in formats:
+            formats.append(format)
+    return formats
+
+
+def get_mime_type(format):
+    Image.init()
+    return Image.MIME.get(format.upper())
+
+
 def find_extension(format):
     format = format.lower()
 
@@ -74,7 +101,78 @@ def find_extension(format):
     return format
 
 
+class AvatarFieldFile(ImageFieldFile):
+    def save(self, name, content, save=True):
+        if settings.AVATAR_NORMALIZE_ORIGINALS:
+            name, content = self.normalize(name, content)
+        # The placeholder and thumbnails of the previous image are stale
+        self.instance.placeholder = ""
+        if self.instance.pk:
+            self.instance.forget_thumbnails()
+        super().save(name, content, save)
+        # Uploads validated by an ImageField come with their parsed header,
+        # spare reopening the file to get the dimensions.
+        image = getattr(content, "image", None)
+        if image is not None:
+            self._dimensions_cache = image.size
+
+    def normalize(self, name, content):
+        """
+        Returns the name and content of the uploaded image shrunk to
+        ``AVATAR_MAX_ORIGINAL_DIMENSION``, rotated according to its EXIF
+        orientation and saved without metadata as ``AVATAR_ORIGINAL_FORMAT``,
+        in RGB or RGBA. Images with an embedded ICC profile are converted to
+        sRGB, or keep their profile when it can't be used.
+        """
+        content.seek(0)
+        try:
+            image = Image.open(content)
+            icc_profile = image.info.get("icc_profile")
+            max_dimension = settings.AVATAR_MAX_ORIGINAL_DIMENSION
+            if max_dimension:
+                # Lets JPEG images be decoded at a reduced scale
+                image.thumbnail(
+                    (max_dimension, max_dimension),
+                    settings.AVATAR_RESIZE_METHOD,
+                    reducing_gap=settings.AVATAR_RESIZE_REDUCING_GAP,
+                )
+            image = ImageOps.exif_transpose(image)
+        except IOError:
+            # Left to the validation of the upload
+            content.seek(0)
+            return name, content
+        format = settings.AVATAR_ORIGINAL_FORMAT
+        if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+            mode = "RGBA"
+            if format == "JPEG":
+                format = "PNG"
+        else:
+            mode = "RGB"
+        options = {}
+        if icc_profile:
+            try:
+                if image.mode not in ("RGB", "RGBA", "CMYK", "L"):
+                    image = image.convert(mode)
+                image = ImageCms.profileToProfile(
+                    image,
+                    ImageCms.ImageCmsProfile(BytesIO(icc_profile)),
+                    ImageCms.createProfile("sRGB"),
+                    outputMode=mode,
+                )
+            except (ImageCms.PyCMSError, OSError):
+                # Leave the colors to be managed by the browser
+                options["icc_profile"] = icc_profile
+        if image.mode != mode:
+            image = image.convert(mode)
+        data = BytesIO()
+        image.save(data, format, quality=settings.AVATAR_ORIGINAL_QUALITY, **options)
+        root = os.path.splitext(name)[0]
+        return root + "." + find_extension(format), ContentFile(data.getvalue())
+
+
 class AvatarField(models.ImageField):
+    attr_class = AvatarFieldFile
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -103,92 +201,323 @@ class Avatar(models.Model):
         verbose_name=_("uploaded at"),
         default=now,
     )
+    placeholder = models.TextField(
+        verbose_name=_("placeholder"),
+        blank=True,
+        editable=False,
+    )
 
     class Meta:
         app_label = "avatar"
         verbose_name = _("avatar")
         verbose_name_plural = _("avatars")
+        indexes = [
+            # Primary avatar lookups, see get_primary_avatar()
+            models.Index(
+                fields=["user", "-primary", "-date_uploaded"],
+                name="avatar_user_primary_idx",
+            ),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user"],
+                condition=Q(primary=True),
+                name="avatar_one_primary_per_user",
+            ),
+        ]
 
     def __str__(self):
         return _("Avatar for %s") % self.user
 
     def save(self, *args, **kwargs):
-        avatars = Avatar.objects.filter(user=self.user)
+        avatars = Avatar.objects.filter(user_id=self.user_id)
         if self.pk:
             avatars = avatars.exclude(pk=self.pk)
-        if settings.AVATAR_MAX_AVATARS_PER_USER > 1:
-            if self.primary:
-                avatars = avatars.filter(primary=True)
-                avatars.update(primary=False)
+        single = settings.AVATAR_MAX_AVATARS_PER_USER <= 1
+        with transaction.atomic():
+            if self.primary or single:
+                self.lock_user()
+            if not single:
+                if self.primary:
+                    avatars.filter(primary=True).update(primary=False)
+            else:
+                avatars.delete()
+            super().save(*args, **kwargs)
+            self.update_primary_pointer()
+
+    def lock_user(self):
+        """
+        Locks the row of the user until the end of the transaction, so that
+        concurrent saves of primary avatars for the same user, such as a
+        double-submitted upload, demote each other's avatar instead of
+        breaking the single primary avatar constraint.
+        """
+        User = self._meta.get_field("user").related_model
+        list(
+            User._default_manager.select_for_update()
+            .filter(pk=self.user_id)
+            .values_list("pk", flat=True)
+        )
+
+    def update_primary_pointer(self):
+        """
+        Points the ``AVATAR_PRIMARY_AVATAR_FIELD`` of the user to this avatar
+        if it is primary, or clears it if it pointed to this avatar.
+        """
+        field = settings.AVATAR_PRIMARY_AVATAR_FIELD
+        if not field:
+            return
+        user_field = self._meta.get_field("user")
+        User = user_field.related_model
+        users = User._default_manager.filter(pk=self.user_id)
+        if self.primary:
+            users.update(**{field: self.pk})
+            pointer = self.pk
         else:
-            avatars.delete()
-        super().save(*args, **kwargs)
-
-    def thumbnail_exists(self, width, height=None):
-        return self.avatar.storage.exists(self.avatar_name(width, height))
+            users.filter(**{field: self.pk}).update(**{field: None})
+            pointer = None
+        # Keep the loaded user in sync
+        if user_field.is_cached(self):
+            attname = User._meta.get_field(field).attname
+            if self.primary or getattr(self.user, attname) == self.pk:
+                setattr(self.user, attname, pointer)
+
+    @cached_property
+    def thumbnail_manifest(self):
+        """
+        Set of the ``(width, height, format)`` thumbnails recorded in the
+        database for this avatar. Use ``prefetch_related("thumbnails")`` to
+        load it for many avatars at once.
+        """
+        return {
+            (thumbnail.width, thumbnail.height, thumbnail.format)
+            for thumbnail in self.thumbnails.all()
+        }
+
+    def thumbnail_exists(self, width, height=None, format=None):
+        width, height = snap_size(width, height)
+        format = format or settings.AVATAR_THUMB_FORMAT
+        if (width, height, format) in self.thumbnail_manifest:
+            return True
+        if not settings.AVATAR_THUMBNAIL_STORAGE_FALLBACK:
+            return False
+        # Thumbnails created before the manifest existed are recorded the
+        # first time they are looked up.
+        if self.avatar.storage.exists(self.avatar_name(width, height, format)):
+            self.record_thumbnails([(width, height, format)])
+            return True
+        return False
+
+    def record_thumbnails(self, thumbnails):
+        """
+        Records the given ``(width, height, format)`` or ``(width, height,
+        format, size, checksum)`` thumbnails in the manifest, replacing
+        previous entries.
+        """
+        thumbnails = [
+            AvatarThumbnail(
+                avatar=self,
+                width=thumbnail[0],
+                height=thumbnail[1],
+                format=thumbnail[2],
+                size=thumbnail[3] if len(thumbnail) > 3 else None,
+                checksum=thumbnail[4] if len(thumbnail) > 4 else "",
+            )
+            for thumbnail in thumbnails
+        ]
+        if not thumbnails:
+            return
+        query = Q()
+        for thumbnail in thumbnails:
+            query |= Q(
+                width=thumbnail.width,
+                height=thumbnail.height,
+                format=thumbnail.format,
+            )
+        with transaction.atomic():
+            self.thumbnails.filter(query).delete()
+            AvatarThumbnail.objects.bulk_create(
+                thumbnails,
+                ignore_conflicts=connection.features.supports_ignore_conflicts,
+            )
+        if "thumbnail_manifest" in self.__dict__:
+            self.thumbnail_manifest.update(
+                (thumbnail.width, thumbnail.height, thumbnail.format)
+                for thumbnail in thumbnails
+            )
+
+    def forget_thumbnails(self):
+        """Removes all thumbnails of this avatar from the manifest."""
+        AvatarThumbnail.objects.filter(avatar_id=self.pk).delete()
+        self.__dict__.pop("thumbnail_manifest", None)
 
     def transpose_image(self, image):
-        EXIF_ORIENTATION = 0x0112
-        exif_code = image.getexif().get(EXIF_ORIENTATION, 1)
-        if exif_code and exif_code != 1:
-            image = ImageOps.exif_transpose(image)
-        return image
+        return PillowBackend().orient(image)
 
-    def create_thumbnail(self, width, height=None, quality=None):
+    def create_thumbnail(self, width, height=None, quality=None, formats=None):
         if height is None:
             height = width
-        # invalidate the cache of the thumbnail with the given size first
-        invalidate_cache(self.user, width, height)
+        self.create_thumbnails([(width, height)], quality=quality, formats=formats)
+
+    def create_thumbnails(self, sizes, quality=None, formats=None):
+        """
+        Creates thumbnails for all the given sizes, decoding the original
+        image only once. ``sizes`` is an iterable of integers and/or
+        ``(width, height)`` sequences, like ``AVATAR_AUTO_GENERATE_SIZES``.
+        Each size is encoded in all the ``formats``, which default to
+        ``thumbnail_formats()``.
+        """
+        sizes = normalize_sizes(snap_size(*size) for size in normalize_sizes(sizes))
+        formats = formats or thumbnail_formats()
+        if not sizes:
+            return
         try:
             orig = self.avatar.storage.open(self.avatar.name, "rb")
         except IOError:
             return  # What should we do here?  Render a "sorry, didn't work" img?
 
+        # The placeholder comes out of the same decode as the thumbnails
+        placeholder = bool(settings.AVATAR_PLACEHOLDER_SIZE) and not self.placeholder
         with closing(orig):
+            quality = quality or settings.AVATAR_THUMB_QUALITY
             try:
-                image = Image.open(orig)
+                thumbnails, placeholder = get_image_backend().create_thumbnails(
+                    orig, sizes, formats, quality, placeholder=placeholder
+                )
             except IOError:
-                thumb_file = File(orig)
-            else:
-                image = self.transpose_image(image)
-                quality = quality or settings.AVATAR_THUMB_QUALITY
-                w, h = image.size
-                if w != width or h != height:
-                    ratioReal = 1.0 * w / h
-                    ratioWant = 1.0 * width / height
-                    if ratioReal > ratioWant:
-                        diff = int((w - (h * ratioWant)) / 2)
-                        image = image.crop((diff, 0, w - diff, h))
-                    elif ratioReal < ratioWant:
-                        diff = int((h - (w / ratioWant)) / 2)
-                        image = image.crop((0, diff, w, h - diff))
-                    if settings.AVATAR_THUMB_FORMAT == "JPEG" and image.mode == "RGBA":
-                        image = image.convert("RGB")
-                    elif image.mode not in (settings.AVATAR_THUMB_MODES):
-                        image = image.convert(settings.AVATAR_THUMB_MODES[0])
-                    image = image.resize((width, height), settings.AVATAR_RESIZE_METHOD)
-                    thumb = BytesIO()
-                    image.save(thumb, settings.AVATAR_THUMB_FORMAT, quality=quality)
-                    thumb_file = ContentFile(thumb.getvalue())
-                else:
-                    thumb_file = File(orig)
-            thumb_name = self.avatar_name(width, height)
-            thumb = self.avatar.storage.save(thumb_name, thumb_file)
-            invalidate_cache(self.user, width, height)
-
-    def avatar_url(self, width, height=None):
-        return self.avatar.storage.url(self.avatar_name(width, height))
+                placeholder = None
+                # Not an image, nothing to convert
+                orig.seek(0)
+                data = orig.read()
+                thumbnails = [
+                    (width, height, settings.AVATAR_THUMB_FORMAT, data)
+                    for width, height in sizes
+                ]
+        manifest = []
+        for width, height, format, data in thumbnails:
+            thumb_name = self.avatar_name(width, height, format)
+            self.avatar.storage.save(thumb_name, ContentFile(data))
+            manifest.append(
+                (width, height, format, len(data), hashlib.md5(data).hexdigest())
+            )
+        self.record_thumbnails(manifest)
+        if placeholder:
+            self.set_placeholder(placeholder)
+        invalidate_cache(self.user)
+
+    def create_placeholder(self):
+        """
+        Generates the placeholder of this avatar from its original image and
+        returns whether it succeeded.
+        """
+        try:
+            orig = self.avatar.storage.open(self.avatar.name, "rb")
+        except IOError:
+            return False
+        with closing(orig):
+            try:
+                data = get_image_backend().create_placeholder(orig)
+            except IOError:
+                return False
+        self.set_placeholder(data)
+        invalidate_cache(self.user)
+        return True
+
+    def set_placeholder(self, data):
+        """
+        Stores the bytes of a placeholder image as a ``data:`` URI, without
+        going through ``save()`` and its signals.
+        """
+        self.placeholder = "data:%s;base64,%s" % (
+            get_mime_type(settings.AVATAR_PLACEHOLDER_FORMAT),
+            base64.b64encode(data).decode("ascii"),
+        )
+        Avatar.objects.filter(pk=self.pk).update(placeholder=self.placeholder)
+
+    def avatar_url(self, width, height=None, format=None):
+        width, height = snap_size(width, height)
+        return self.avatar.storage.url(self.avatar_name(width, height, format))
 
     def get_absolute_url(self):
         return self.avatar_url(settings.AVATAR_DEFAULT_SIZE)
 
-    def avatar_name(self, width, height=None):
+    def avatar_name(self, width, height=None, format=None):
         if height is None:
             height = width
-        ext = find_extension(settings.AVATAR_THUMB_FORMAT)
+        ext = find_extension(format or settings.AVATAR_THUMB_FORMAT)
         return avatar_file_path(instance=self, width=width, height=height, ext=ext)
 
 
+class AvatarThumbnail(models.Model):
+    """
+    A thumbnail stored for an avatar, so that looking it up doesn't need to
+    ask the storage.
+    """
+
+    avatar = models.ForeignKey(
+        Avatar,
+        verbose_name=_("avatar"),
+        related_name="thumbnails",
+        on_delete=models.CASCADE,
+    )
+    width = models.PositiveIntegerField(verbose_name=_("width"))
+    height = models.PositiveIntegerField(verbose_name=_("height"))
+    format = models.CharField(verbose_name=_("format"), max_length=16)
+    size = models.PositiveIntegerField(verbose_name=_("size"), null=True)
+    checksum = models.CharField(verbose_name=_("checksum"), max_length=32, blank=True)
+    date_created = models.DateTimeField(
+        verbose_name=_("created at"),
+        default=now,
+    )
+
+    class Meta:
+        app_label = "avatar"
+        verbose_name = _("avatar thumbnail")
+        verbose_name_plural = _("avatar thumbnails")
+        constraints = [
+            models.UniqueConstraint(
+                fields=["avatar", "width", "height", "format"],
+                name="avatar_thumbnail_unique_rendition",
+            )
+        ]
+
+    def __str__(self):
+        return "%s (%sx%s %s)" % (self.avatar, self.width, self.height, self.format)
+
+
+class ThumbnailTask(models.Model):
+    """
+    Thumbnails waiting to be generated by the ``process_avatar_thumbnails``
+    management command, see ``avatar.tasks.DatabaseBackend``.
+    """
+
+    avatar = models.ForeignKey(
+        Avatar,
+        verbose_name=_("avatar"),
+        related_name="thumbnail_tasks",
+        on_delete=models.CASCADE,
+    )
+    sizes = models.JSONField(verbose_name=_("sizes"))
+    date_created = models.DateTimeField(
+        verbose_name=_("created at"),
+        default=now,
+    )
+    date_claimed = models.DateTimeField(
+        verbose_name=_("claimed at"),
+        null=True,
+        blank=True,
+    )
+    error = models.TextField(verbose_name=_("error"), blank=True)
+
+    class Meta:
+        app_label = "avatar"
+        verbose_name = _("thumbnail task")
+        verbose_name_plural = _("thumbnail tasks")
+
+    def __str__(self):
+        return _("Thumbnails for %s") % self.avatar
+
+
 def invalidate_avatar_cache(sender, instance, **kwargs):
     if hasattr(instance, "user"):
         invalidate_cache(instance.user)
@@ -197,12 +526,9 @@ def invalidate_avatar_cache(sender, instance, **kwargs):
 def create_default_thumbnails(sender, instance, created=False, **kwargs):
     invalidate_avatar_cache(sender, instance)
     if created:
-        for size in settings.AVATAR_AUTO_GENERATE_SIZES:
-            if isinstance(size, int):
-                instance.create_thumbnail(size, size)
-            else:
-                # Size is specified with height and width.
-                instance.create_thumbnail(size[0], size[1])
+        get_thumbnail_task_backend().enqueue(
+            instance, normalize_sizes(settings.AVATAR_AUTO_GENERATE_SIZES)
+        )
 
 
 def remove_avatar_images(instance=None, delete_main_avatar=True, **kwargs):
@@ -215,8 +541,11 @@ def remove_avatar_images(instance=None, delete_main_avatar=True, **kwargs):
         resized_width_path = os.path.join(resized_path, width)
         resized_heights, _ = instance.avatar.storage.listdir(resized_width_path)
         for height in resized_heights:
-            if instance.thumbnail_exists(width, height):
-                instance.avatar.storage.delete(instance.avatar_name(width, height))
+            for format in thumbnail_formats():
+                thumb_name = instance.avatar_name(width, height, format)
+                if instance.avatar.storage.exists(thumb_name):
+                    instance.avatar.storage.delete(thumb_name)
+    instance.forget_thumbnails()
     if delete_main_avatar:
         if instance.avatar.storage.exists(instance.avatar.name):
             instance.avatar.storage.delete(instance.avatar.name)
@@ -1,26 +1,57 @@
 import hashlib
 import re
+import threading
 from urllib.parse import urlencode, urljoin
 
+import dns.exception
 import dns.resolver
+from django.core.cache import cache
 from django.utils.module_loading import import_string
 
 from avatar.conf import settings
-from avatar.utils import force_bytes, get_default_avatar_url, get_primary_avatar
+from avatar.utils import (
+    force_bytes,
+    get_cache_key,
+    get_default_avatar_url,
+    get_primary_avatar,
+    get_primary_avatars,
+)
 
-# If the FacebookAvatarProvider is used, a mechanism needs to be defined on
-# how to obtain the user's Facebook UID. This is done via
-# ``AVATAR_FACEBOOK_GET_ID``.
-get_facebook_id = None
 
-if "avatar.providers.FacebookAvatarProvider" in settings.AVATAR_PROVIDERS:
-    if callable(settings.AVATAR_FACEBOOK_GET_ID):
-        get_facebook_id = settings.AVATAR_FACEBOOK_GET_ID
-    else:
-        get_facebook_id = import_string(settings.AVATAR_FACEBOOK_GET_ID)
+class AvatarProvider(object):
+    """
+    Base class of the providers, implementing the bulk ``get_avatar_urls``
+    on top of ``get_avatar_url``.
+    """
+
+    @classmethod
+    def setup(cls):
+        """
+        Called when the provider chain is loaded from ``AVATAR_PROVIDERS``.
+        """
+
+    @classmethod
+    def can_provide(cls, user):
+        """
+        Returns ``False`` if the provider can never have an avatar for the
+        user, so that it is skipped without being called.
+        """
+        return True
 
+    @classmethod
+    def get_avatar_url(cls, user, width, height=None):
+        raise NotImplementedError
+
+    @classmethod
+    def get_avatar_urls(cls, users, width, height=None):
+        """
+        Returns a dictionary mapping the primary keys of the given users to
+        their avatar URL, or ``None`` if the provider has no avatar for them.
+        """
+        return {user.pk: cls.get_avatar_url(user, width, height) for user in users}
 
-class DefaultAvatarProvider(object):
+
+class DefaultAvatarProvider(AvatarProvider):
     """
     Returns the default url defined by ``settings.DEFAULT_AVATAR_URL``.
     """
@@ -30,7 +61,7 @@ class DefaultAvatarProvider(object):
         return get_default_avatar_url()
 
 
-class PrimaryAvatarProvider(object):
+class PrimaryAvatarProvider(AvatarProvider):
     """
     Returns the primary Avatar from the users avatar set.
     """
@@ -41,14 +72,38 @@ class PrimaryAvatarProvider(object):
             height = width
         avatar = get_primary_avatar(user, width, height)
         if avatar:
-            return avatar.avatar_url(width, height)
+            return cls.get_url(avatar, width, height)
 
+    @classmethod
+    def get_avatar_urls(cls, users, width, height=None):
+        if not height:
+            height = width
+        avatars = get_primary_avatars(users, width, height)
+        return {
+            pk: cls.get_url(avatar, width, height) for pk, avatar in avatars.items()
+        }
 
-class GravatarAvatarProvider(object):
+    @classmethod
+    def get_url(cls, avatar, width, height):
+        if not avatar.thumbnail_exists(width, height):
+            # Thumbnails are still being generated, by the task backend or by
+            # another request, use the original or let the next providers
+            # answer meanwhile.
+            if settings.AVATAR_PENDING_USE_ORIGINAL:
+                return avatar.avatar.url
+            return None
+        return avatar.avatar_url(width, height)
+
+
+class GravatarAvatarProvider(AvatarProvider):
     """
     Returns the url for an avatar by the Gravatar service.
     """
 
+    @classmethod
+    def can_provide(cls, user):
+        return bool(getattr(user, settings.AVATAR_GRAVATAR_FIELD, None))
+
     @classmethod
     def get_avatar_url(cls, user, width, _height=None):
         params = {"s": str(width)}
@@ -66,28 +121,97 @@ class GravatarAvatarProvider(object):
         return urljoin(settings.AVATAR_GRAVATAR_BASE_URL, path)
 
 
-class LibRAvatarProvider:
+class LibRAvatarProvider(AvatarProvider):
     """
     Returns the url of an avatar by the LibRavatar service.
+
+    The federated server of each email domain is looked up once per TTL of
+    its DNS SRV record and shared through the cache.
     """
 
+    default_base_url = "https://seccdn.libravatar.org/avatar/"
+    resolver = None
+    # Lookups of the same domain are serialized, so that concurrent requests
+    # wait for the first one instead of querying the DNS again.
+    lookup_locks = [threading.Lock() for _ in range(16)]
+
+    @classmethod
+    def can_provide(cls, user):
+        return bool(getattr(user, settings.AVATAR_GRAVATAR_FIELD, None))
+
     @classmethod
     def get_avatar_url(cls, user, width, _height=None):
-        email = getattr(user, settings.AVATAR_GRAVATAR_FIELD).encode("utf-8")
+        email = getattr(user, settings.AVATAR_GRAVATAR_FIELD)
+        return cls.build_url(cls.get_base_url(cls.get_domain(email)), email, width)
+
+    @classmethod
+    def get_avatar_urls(cls, users, width, height=None):
+        base_urls = {}
+        urls = {}
+        for user in users:
+            email = getattr(user, settings.AVATAR_GRAVATAR_FIELD)
+            domain = cls.get_domain(email)
+            if domain not in base_urls:
+                base_urls[domain] = cls.get_base_url(domain)
+            urls[user.pk] = cls.build_url(base_urls[domain], email, width)
+        return urls
+
+    @classmethod
+    def get_domain(cls, email):
+        if "@" not in email:
+            return None
+        return email.rsplit("@", 1)[1].strip().lower()
+
+    @classmethod
+    def get_base_url(cls, domain):
+        if not domain:
+            return cls.default_base_url
+        key = get_cache_key(domain, "libravatar_base_url")
+        base_url = cache.get(key)
+        if base_url is None:
+            with cls.lookup_locks[hash(domain) % len(cls.lookup_locks)]:
+                base_url = cache.get(key)
+                if base_url is None:
+                    base_url, ttl = cls.lookup_base_url(domain)
+                    cache.set(key, base_url, ttl)
+        # Domains without a federated server are cached as an empty string
+        return base_url or cls.default_base_url
+
+    @classmethod
+    def get_resolver(cls):
+        if cls.resolver is None:
+            cls.resolver = dns.resolver.Resolver()
+        return cls.resolver
+
+    @classmethod
+    def lookup_base_url(cls, domain):
+        """
+        Returns the base url of the federated avatar server of the domain, or
+        an empty string if there is none, and how long to cache it for.
+        """
         try:
-            _, domain = email.split(b"@")
-            answers = dns.resolver.query("_avatars._tcp." + domain, "SRV")
-            hostname = re.sub(r"\.$", "", str(answers[0].target))
-            # query returns "example.com." and while http requests are fine with this,
-            # https most certainly do not consider "example.com." and "example.com" to be the same.
-            port = str(answers[0].port)
-            if port == "443":
-                baseurl = "https://" + hostname + "/avatar/"
-            else:
-                baseurl = "http://" + hostname + ":" + port + "/avatar/"
-        except Exception:
-            baseurl = "https://seccdn.libravatar.org/avatar/"
+            resolver = cls.get_resolver()
+            resolver.timeout = settings.AVATAR_LIBRAVATAR_DNS_TIMEOUT
+            answers = resolver.resolve(
+                "_avatars._tcp." + domain,
+                "SRV",
+                lifetime=settings.AVATAR_LIBRAVATAR_DNS_LIFETIME,
+            )
+        except dns.exception.DNSException:
+            # NXDOMAIN, no SRV record or an unresponsive DNS server
+            return "", settings.AVATAR_LIBRAVATAR_NEGATIVE_CACHE_TIMEOUT
+        # query returns "example.com." and while http requests are fine with this,
+        # https most certainly do not consider "example.com." and "example.com" to be the same.
+        hostname = re.sub(r"\.$", "", str(answers[0].target))
+        port = str(answers[0].port)
+        if port == "443":
+            base_url = "https://" + hostname + "/avatar/"
+        else:
+            base_url = "http://" + hostname + ":" + port + "/avatar/"
+        return base_url, answers.rrset.ttl
 
+    @classmethod
+    def build_url(cls, base_url, email, width):
         params = {"s": str(width)}
         if settings.AVATAR_GRAVATAR_DEFAULT:
             params["d"] = settings.AVATAR_GRAVATAR_DEFAULT
@@ -97,25 +221,38 @@ class LibRAvatarProvider:
             hashlib.md5(force_bytes(email.strip().lower())).hexdigest(),
             urlencode(params),
         )
-        return urljoin(baseurl, path)
+        return urljoin(base_url, path)
 
 
-class FacebookAvatarProvider(object):
+class FacebookAvatarProvider(AvatarProvider):
     """
     Returns the url of a Facebook profile image.
     """
 
+    # A mechanism needs to be defined on how to obtain the user's Facebook
+    # UID. This is done via ``AVATAR_FACEBOOK_GET_ID``.
+    get_facebook_id = None
+
+    @classmethod
+    def setup(cls):
+        if callable(settings.AVATAR_FACEBOOK_GET_ID):
+            cls.get_facebook_id = staticmethod(settings.AVATAR_FACEBOOK_GET_ID)
+        else:
+            cls.get_facebook_id = staticmethod(
+                import_string(settings.AVATAR_FACEBOOK_GET_ID)
+            )
+
     @classmethod
     def get_avatar_url(cls, user, width, height=None):
         if not height:
             height = width
-        fb_id = get_facebook_id(user)
+        fb_id = cls.get_facebook_id(user)
         if fb_id:
             url = "https://graph.facebook.com/{fb_id}/picture?type=square&width={width}&height={height}"
             return url.format(fb_id=fb_id, width=width, height=height)
 
 
-class InitialsAvatarProvider(object):
+class InitialsAvatarProvider(AvatarProvider):
     """
     Returns a tuple with template_name and context for rendering the given user's avatar as their
     initials in white against a background with random hue based on their primary key.
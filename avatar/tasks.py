@@ -0,0 +1,124 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import connection, connections, transaction
+from django.db.models import Q
+from django.utils.timezone import now
+
+from avatar.conf import settings
+from avatar.models import ThumbnailTask
+
+
+class SynchronousBackend(object):
+    """
+    Generates thumbnails right away, within the request that uploaded the
+    avatar.
+    """
+
+    def enqueue(self, avatar, sizes):
+        avatar.create_thumbnails(sizes)
+
+    def is_pending(self, avatar):
+        return False
+
+
+class ThreadPoolBackend(object):
+    """
+    Generates thumbnails in a pool of ``AVATAR_THUMBNAIL_TASK_WORKERS``
+    threads of the current process, once the upload has been committed.
+    Pending thumbnails are lost if the process exits, so this is only meant
+    for single-node deployments.
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(
+            settings.AVATAR_THUMBNAIL_TASK_WORKERS,
+            thread_name_prefix="avatar-thumbnails",
+        )
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def enqueue(self, avatar, sizes):
+        transaction.on_commit(lambda: self.submit(avatar, sizes))
+
+    def submit(self, avatar, sizes):
+        with self.lock:
+            self.pending[avatar.pk] = self.pending.get(avatar.pk, 0) + 1
+        return self.executor.submit(self.run, avatar, sizes)
+
+    def run(self, avatar, sizes):
+        try:
+            avatar.create_thumbnails(sizes)
+        finally:
+            with self.lock:
+                self.pending[avatar.pk] -= 1
+                if not self.pending[avatar.pk]:
+                    del self.pending[avatar.pk]
+            connections.close_all()
+
+    def is_pending(self, avatar):
+        return avatar.pk in self.pending
+
+
+class DatabaseBackend(object):
+    """
+    Queues thumbnails as ``ThumbnailTask`` rows, to be generated by the
+    ``process_avatar_thumbnails`` management command.
+    """
+
+    # Seconds after which tasks claimed by a worker which died are retried
+    claim_timeout = 10 * 60
+
+    def enqueue(self, avatar, sizes):
+        ThumbnailTask.objects.create(avatar=avatar, sizes=sizes)
+
+    def is_pending(self, avatar):
+        # Failed tasks won't produce the thumbnails, they are created on demand
+        return ThumbnailTask.objects.filter(avatar=avatar, error="").exists()
+
+    def claim(self, limit=None):
+        """
+        Marks the oldest queued tasks as taken by this worker, in a short
+        transaction, and returns their primary keys. Concurrent workers skip
+        each other's tasks on databases supporting
+        ``SELECT ... FOR UPDATE SKIP LOCKED``.
+        """
+        claimed_before = now() - timedelta(seconds=self.claim_timeout)
+        with transaction.atomic():
+            tasks = (
+                ThumbnailTask.objects.select_for_update(
+                    skip_locked=connection.features.has_select_for_update_skip_locked
+                )
+                .filter(error="")
+                .filter(
+                    Q(date_claimed__isnull=True) | Q(date_claimed__lt=claimed_before)
+                )
+                .order_by("pk")
+            )
+            if limit:
+                tasks = tasks[:limit]
+            pks = list(tasks.values_list("pk", flat=True))
+            ThumbnailTask.objects.filter(pk__in=pks).update(date_claimed=now())
+        return pks
+
+    def process(self, limit=None):
+        """
+        Generates the queued thumbnails, oldest first, and returns how many
+        tasks were processed. Each task is deleted once its thumbnails are
+        created, tasks failing are kept with their ``error`` and not retried.
+        """
+        pks = self.claim(limit)
+        tasks = (
+            ThumbnailTask.objects.filter(pk__in=pks)
+            .select_related("avatar__user")
+            .order_by("pk")
+        )
+        for task in tasks:
+            try:
+                task.avatar.create_thumbnails(task.sizes)
+            except Exception as e:
+                ThumbnailTask.objects.filter(pk=task.pk).update(error=repr(e))
+            else:
+                task.delete()
+        return len(pks)
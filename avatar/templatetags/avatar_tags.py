@@ -1,32 +1,55 @@
+import os
+from inspect import unwrap
+
 from django import template
-from django.template.loader import render_to_string
 from django.urls import reverse
-from django.utils.module_loading import import_string
+from django.utils.formats import localize
+from django.utils.html import conditional_escape
+from django.utils.http import urlencode
+from django.utils.safestring import mark_safe
 from django.utils.translation import gettext as _
 
 from avatar.conf import settings
-from avatar.models import Avatar
-from avatar.utils import cache_result, get_default_avatar_url, get_user, get_user_model
+from avatar.models import get_mime_type
+from avatar.utils import (
+    cache_result,
+    create_thumbnails_once,
+    get_avatar_urls,
+    get_compiled_template,
+    get_default_avatar_url,
+    get_has_avatars,
+    get_placeholder,
+    get_prefetched_primary_avatar,
+    get_primary_avatar,
+    get_sprite,
+    get_user,
+    get_user_model,
+    resolve_avatar_url,
+    snap_size,
+)
 
 register = template.Library()
 
+AVATAR_TAG_TEMPLATE = "avatar/avatar_tag.html"
+# Rendered by format_avatar_tag() unless a project overrides it
+DEFAULT_AVATAR_TAG_TEMPLATE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "templates",
+    AVATAR_TAG_TEMPLATE,
+)
+
 
 @cache_result()
 @register.simple_tag
 def avatar_url(user, width=settings.AVATAR_DEFAULT_SIZE, height=None):
-    if height is None:
-        height = width
-    for provider_path in settings.AVATAR_PROVIDERS:
-        provider = import_string(provider_path)
-        avatar_url = provider.get_avatar_url(user, width, height)
-        if avatar_url:
-            return avatar_url
-    return get_default_avatar_url()
+    return resolve_avatar_url(user, width, height)
 
 
-@cache_result()
+@cache_result(key_kwargs=("placeholder",))
 @register.simple_tag
-def avatar(user, width=settings.AVATAR_DEFAULT_SIZE, height=None, **kwargs):
+def avatar(
+    user, width=settings.AVATAR_DEFAULT_SIZE, height=None, placeholder=False, **kwargs
+):
     if height is None:
         height = width
     if not isinstance(user, get_user_model()):
@@ -47,15 +70,23 @@ def avatar(user, width=settings.AVATAR_DEFAULT_SIZE, height=None, **kwargs):
             alt = _("User Avatar")
         url = avatar_url(user, width, height)
     kwargs.update({"alt": alt})
+    placeholder = get_placeholder(user) if placeholder else ""
+    if placeholder:
+        # Painted until the image is loaded
+        style = "background: url(%s) center / cover" % placeholder
+        if kwargs.get("style"):
+            style = "%s; %s" % (style, kwargs["style"])
+        kwargs["style"] = style
 
     context = {
         "user": user,
         "alt": alt,
         "width": width,
         "height": height,
+        "placeholder": placeholder,
         "kwargs": kwargs,
     }
-    template_name = "avatar/avatar_tag.html"
+    template_name = AVATAR_TAG_TEMPLATE
     ext_context = None
     try:
         template_name, ext_context = url
@@ -63,14 +94,212 @@ def avatar(user, width=settings.AVATAR_DEFAULT_SIZE, height=None, **kwargs):
         context["url"] = url
     if ext_context:
         context = dict(context, **ext_context)
-    return render_to_string(template_name, context)
+    template = get_compiled_template(template_name)
+    if (
+        settings.AVATAR_FAST_TAG_RENDERING
+        and ext_context is None
+        and template_name == AVATAR_TAG_TEMPLATE
+        and template.origin.name == DEFAULT_AVATAR_TAG_TEMPLATE
+    ):
+        return format_avatar_tag(url, width, height, kwargs)
+    return template.render(context)
+
+
+def format_avatar_tag(url, width, height, attrs):
+    """
+    Renders the ``img`` element of the default ``avatar/avatar_tag.html``
+    template with string formatting, escaping the values the same way.
+    """
+
+    def render_value(value):
+        return conditional_escape(localize(value))
+
+    return mark_safe(
+        '<img src="%s" width="%s" height="%s" %s/>\n'
+        % (
+            render_value(url),
+            render_value(width),
+            render_value(height),
+            "".join(
+                '%s="%s" ' % (render_value(key), render_value(value))
+                for key, value in attrs.items()
+            ),
+        )
+    )
+
+
+@cache_result(key_kwargs=("placeholder",))
+@register.simple_tag
+def avatar_picture(user, width=settings.AVATAR_DEFAULT_SIZE, height=None, **kwargs):
+    """
+    Like the ``avatar`` tag, wrapped in a ``<picture>`` element offering the
+    thumbnails of the primary avatar in ``AVATAR_THUMB_EXTRA_FORMATS``.
+    """
+    if height is None:
+        height = width
+    img = avatar(user, width, height, **kwargs)
+    sources = []
+    if not isinstance(user, get_user_model()):
+        try:
+            user = get_user(user)
+        except get_user_model().DoesNotExist:
+            user = None
+    primary = get_primary_avatar(user, width, height) if user else None
+    # Only when the avatar comes from the PrimaryAvatarProvider
+    if primary and avatar_url(user, width, height) == primary.avatar_url(width, height):
+        for format in settings.AVATAR_THUMB_EXTRA_FORMATS:
+            if primary.thumbnail_exists(width, height, format):
+                sources.append(
+                    {
+                        "srcset": primary.avatar_url(width, height, format),
+                        "type": get_mime_type(format),
+                    }
+                )
+    return get_compiled_template("avatar/avatar_picture.html").render(
+        {"img": img, "sources": sources}
+    )
+
+
+def parse_densities(densities):
+    """
+    Turns a comma-separated string or an iterable of pixel densities, such as
+    ``"1,1.5x,2"``, into a sorted list of numbers.
+    """
+    if isinstance(densities, str):
+        densities = densities.split(",")
+    return sorted({float(str(density).strip().rstrip("x")) for density in densities})
+
+
+def get_srcset_sizes(width, height, densities):
+    return [(round(width * density), round(height * density)) for density in densities]
+
+
+def resolve_srcset_user(user):
+    try:
+        return user if isinstance(user, get_user_model()) else get_user(user)
+    except get_user_model().DoesNotExist:
+        return None
+
+
+def create_srcset_thumbnails(
+    user, width=settings.AVATAR_DEFAULT_SIZE, height=None, densities="1,2", **kwargs
+):
+    """
+    Creates the missing thumbnails of the primary avatar needed by
+    ``avatar_srcset``, all from a single decode of the original.
+    """
+    if height is None:
+        height = width
+    resolved_user = resolve_srcset_user(user)
+    if (
+        resolved_user is None
+        or "avatar.providers.PrimaryAvatarProvider" not in settings.AVATAR_PROVIDERS
+    ):
+        return
+    sizes = get_srcset_sizes(width, height, parse_densities(densities))
+    primary = get_prefetched_primary_avatar(resolved_user)
+    if primary is None:
+        primary = resolved_user.avatar_set.order_by("-primary", "-date_uploaded")
+    for primary_avatar in primary[:1]:
+        create_thumbnails_once(primary_avatar, sizes)
+
+
+@register.simple_tag
+@cache_result(key_kwargs=("densities", "placeholder"), prepare=create_srcset_thumbnails)
+def avatar_srcset(
+    user, width=settings.AVATAR_DEFAULT_SIZE, height=None, densities="1,2", **kwargs
+):
+    """
+    Like the ``avatar`` tag, with a ``srcset`` offering the avatar at each of
+    the given pixel densities. The missing thumbnails of the primary avatar
+    are all created from a single decode of the original, before the result
+    is cached.
+    """
+    if height is None:
+        height = width
+    densities = parse_densities(densities)
+    sizes = get_srcset_sizes(width, height, densities)
+    resolved_user = resolve_srcset_user(user)
+    srcset = {}
+    for density, size in zip(densities, sizes):
+        if resolved_user is None:
+            url = get_default_avatar_url()
+        else:
+            url = resolve_avatar_url(resolved_user, *size)
+        # Thumbnails snapped to the same size are offered once
+        srcset.setdefault(url, density)
+    kwargs["srcset"] = ", ".join(
+        "%s %gx" % (url, density) for url, density in srcset.items()
+    )
+    # The cached avatar tag doesn't tell results apart by their attributes
+    return unwrap(avatar)(user, width, height, **kwargs)
+
+
+@register.simple_tag
+def avatars_for(users, width=settings.AVATAR_DEFAULT_SIZE, height=None):
+    """
+    Resolves the avatar URLs of many users at once and returns a list of
+    ``(user, url)`` pairs, in the order of ``users``.
+    """
+    users = list(users)
+    urls = get_avatar_urls(users, width, height)
+    return [(user, urls[user.pk]) for user in users]
+
+
+@register.simple_tag
+def avatar_sprite(users, width=settings.AVATAR_DEFAULT_SIZE, height=None):
+    """
+    Returns the URL of the sprite sheet of the primary avatars of the given
+    users and, in the order of ``users``, the CSS offsets of each of them.
+    Users without an avatar get their own URL instead.
+    """
+    if height is None:
+        height = width
+    width, height = snap_size(width, height)
+    users = list(users)
+    if (
+        max(width, height) > settings.AVATAR_SPRITE_MAX_SIZE
+        or len({user.pk for user in users}) > settings.AVATAR_SPRITE_MAX_USERS
+    ):
+        # Too large for a sprite, every avatar gets its own URL
+        positions = {}
+        url = ""
+    else:
+        sprite = get_sprite(users, width, height)
+        positions = sprite["positions"]
+        url = "%s?%s" % (
+            reverse("avatar:render_sprite", kwargs={"width": width, "height": height}),
+            urlencode(
+                {
+                    "users": ",".join(dict.fromkeys(str(user.pk) for user in users)),
+                    "v": sprite["version"],
+                }
+            ),
+        )
+    others = [user for user in users if user.pk not in positions]
+    urls = get_avatar_urls(others, width, height) if others else {}
+    avatars = []
+    for user in users:
+        if user.pk in positions:
+            x, y = positions[user.pk]
+            style = "background: url(%s) %dpx %dpx; width: %dpx; height: %dpx" % (
+                url,
+                -x,
+                -y,
+                width,
+                height,
+            )
+            avatars.append({"user": user, "url": url, "x": x, "y": y, "style": style})
+        else:
+            avatars.append({"user": user, "url": urls[user.pk], "style": ""})
+    return {"url": url, "width": width, "height": height, "avatars": avatars}
 
 
 @register.filter
 def has_avatar(user):
     if not isinstance(user, get_user_model()):
         return False
-    return Avatar.objects.filter(user=user, primary=True).exists()
+    return get_has_avatars([user])[user.pk]
 
 
 @cache_result()
@@ -21,4 +21,10 @@ urlpatterns = [
         views.render_primary,
         name="render_primary",
     ),
+    path("sprite/<int:width>/", views.render_sprite, name="render_sprite"),
+    path(
+        "sprite/<int:width>/<int:height>/",
+        views.render_sprite,
+        name="render_sprite",
+    ),
 ]
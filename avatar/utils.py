@@ -1,13 +1,33 @@
 import hashlib
+import math
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+from functools import lru_cache, wraps
+from io import BytesIO
 
 from django.contrib.auth import get_user_model
 from django.core.cache import cache
+from django.core.signals import request_started, setting_changed
+from django.db.models import F, Prefetch, Window, prefetch_related_objects
+from django.db.models.functions import RowNumber
+from django.dispatch import receiver
 from django.template.defaultfilters import slugify
+from django.template.loader import get_template
+from django.utils.autoreload import file_changed
 from django.utils.encoding import force_bytes
+from django.utils.module_loading import import_string
 
 from avatar.conf import settings
 
 cached_funcs = set()
+thumbnail_task_backends = {}
+image_backends = {}
+cache_stats = Counter()
+provider_stats = defaultdict(lambda: {"calls": 0, "skips": 0, "seconds": 0.0})
+LOCAL_CACHE_STAMP_KEY = "avatar_local_cache_stamp"
+# Attribute of users holding the result of primary_avatar_prefetch()
+PRIMARY_AVATAR_ATTR = "prefetched_primary_avatar"
 
 
 def get_username(user):
@@ -32,9 +52,61 @@ def get_user(userdescriptor):
     return User.objects.get_by_natural_key(userdescriptor)
 
 
-def get_cache_key(user_or_username, prefix, width=None, height=None):
+def normalize_sizes(sizes):
     """
-    Returns a cache key consisten of a username and image size.
+    Turns an iterable of integers and/or ``(width, height)`` sequences into a
+    list of unique ``(width, height)`` tuples, largest first.
+    """
+    normalized = set()
+    for size in sizes:
+        if isinstance(size, int):
+            normalized.add((size, size))
+        else:
+            # Size is specified with height and width.
+            normalized.add((size[0], size[1]))
+    return sorted(normalized, key=lambda size: size[0] * size[1], reverse=True)
+
+
+def snap_size(width, height=None):
+    """
+    Returns the size thumbnails of the given size are served at: the smallest
+    of the ``AVATAR_ALLOWED_SIZES`` at least as large, preferably with the
+    same aspect ratio, or the largest one if the size exceeds them all.
+    Without ``AVATAR_ALLOWED_SIZES``, any size is served as is.
+    """
+    if height is None:
+        height = width
+    width, height = int(width), int(height)
+    if not settings.AVATAR_ALLOWED_SIZES:
+        return width, height
+    allowed = normalize_sizes(settings.AVATAR_ALLOWED_SIZES)
+    larger = [size for size in allowed if size[0] >= width and size[1] >= height]
+    if not larger:
+        return allowed[0]
+    return min(
+        larger,
+        key=lambda size: (size[0] * height != size[1] * width, size[0] * size[1]),
+    )
+
+
+def get_allowed_size(width, height=None):
+    """
+    Returns the size to serve a request for an avatar of the given size at,
+    see snap_size(). Raises ``ValueError`` if ``AVATAR_SIZE_POLICY`` is
+    ``"reject"`` and the size is not one of the ``AVATAR_ALLOWED_SIZES``.
+    """
+    if height is None:
+        height = width
+    size = snap_size(width, height)
+    if settings.AVATAR_SIZE_POLICY == "reject" and size != (int(width), int(height)):
+        raise ValueError("%sx%s is not an allowed avatar size." % (width, height))
+    return size
+
+
+def get_cache_key(user_or_username, prefix, width=None, height=None, generation=None):
+    """
+    Returns a cache key consisten of a username, image size and optionally
+    the generation of the user's cache entries.
     """
     if isinstance(user_or_username, get_user_model()):
         user_or_username = get_username(user_or_username)
@@ -43,43 +115,234 @@ def get_cache_key(user_or_username, prefix, width=None, height=None):
         key += f"_{width}"
     if height or width:
         key += f"x{height or width}"
+    if generation is not None:
+        key += f"_v{generation}"
     return "%s_%s" % (
         slugify(key)[:100],
         hashlib.md5(force_bytes(key)).hexdigest(),
     )
 
 
+class LocalCache(object):
+    """
+    Bounded, process-local LRU cache sitting in front of the Django cache.
+    Entries expire after ``AVATAR_LOCAL_CACHE_TIMEOUT`` seconds and the least
+    recently used ones are evicted past ``AVATAR_LOCAL_CACHE_SIZE`` entries.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.stamp = None
+
+    @property
+    def enabled(self):
+        return settings.AVATAR_LOCAL_CACHE_SIZE > 0
+
+    def get(self, key):
+        with self.lock:
+            try:
+                expires, value = self.entries[key]
+            except KeyError:
+                return None
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (
+                time.monotonic() + settings.AVATAR_LOCAL_CACHE_TIMEOUT,
+                value,
+            )
+            self.entries.move_to_end(key)
+            while len(self.entries) > settings.AVATAR_LOCAL_CACHE_SIZE:
+                self.entries.popitem(last=False)
+
+    def delete_owner(self, owner):
+        """
+        Drops all the entries of the given user.
+        """
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == owner]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def sync(self):
+        """
+        Clears the cache if any process invalidated a user's avatars since the
+        last call, as told by the stamp shared through the Django cache.
+        """
+        stamp = cache.get(LOCAL_CACHE_STAMP_KEY)
+        if stamp != self.stamp:
+            self.clear()
+            self.stamp = stamp
+
+
+local_cache = LocalCache()
+
+
+def get_local_cache_owner(user):
+    if isinstance(user, get_user_model()):
+        return get_username(user)
+    return str(user)
+
+
+def get_local_cache_key(user, prefix, width=None, height=None):
+    return (get_local_cache_owner(user), prefix, width, height or width)
+
+
+def get_cache_stats():
+    """
+    Returns the number of hits and misses of the local and shared avatar
+    caches since the process started or reset_cache_stats() was called.
+    """
+    return {
+        stat: cache_stats[stat]
+        for stat in ("local_hits", "local_misses", "shared_hits", "shared_misses")
+    }
+
+
+def reset_cache_stats():
+    cache_stats.clear()
+
+
+@receiver(request_started)
+def sync_local_cache(**kwargs):
+    if settings.AVATAR_CACHE_ENABLED and local_cache.enabled:
+        local_cache.sync()
+
+
+@receiver(setting_changed)
+def reset_local_cache(setting, **kwargs):
+    if setting.startswith("AVATAR_LOCAL_CACHE_"):
+        local_cache.clear()
+
+
 def cache_set(key, value):
     cache.set(key, value, settings.AVATAR_CACHE_TIMEOUT)
     return value
 
 
-def cache_result(default_size=settings.AVATAR_DEFAULT_SIZE):
+def new_cache_generation():
+    # Based on the clock rather than starting from 1, so that a generation
+    # evicted from the cache can't come back and reuse stale entries.
+    return time.time_ns() // 1000
+
+
+def get_cache_generations(users):
+    """
+    Returns the current generation of the cache entries of each of the given
+    users, in the same order, using a single cache lookup.
+    """
+    keys = [get_cache_key(user, "generation") for user in users]
+    generations = cache.get_many(keys)
+    for key in keys:
+        if key not in generations:
+            generation = new_cache_generation()
+            if not cache.add(key, generation, None):
+                generation = cache.get(key, generation)
+            generations[key] = generation
+    return [generations[key] for key in keys]
+
+
+def get_cache_keys(users, prefix, width=None, height=None):
+    """
+    Returns the keys caching the results of ``prefix`` for each of the given
+    users, in the same order.
+    """
+    if settings.AVATAR_CACHE_VERSIONED_KEYS:
+        return [
+            get_cache_key(user, prefix, width, height, generation)
+            for user, generation in zip(users, get_cache_generations(users))
+        ]
+    return [get_cache_key(user, prefix, width, height) for user in users]
+
+
+def add_cached_size(users, width, height=None):
+    """
+    Adds the given size to the set of cached sizes of each user, so that
+    invalidate_cache() can find the matching keys later.
+    """
+    sizes_keys = {get_cache_key(user, "cached_sizes"): user for user in users}
+    cached_sizes = cache.get_many(sizes_keys)
+    for sizes_key in sizes_keys:
+        sizes = cached_sizes.setdefault(sizes_key, set())
+        sizes.add((width, height or width))
+    cache.set_many(cached_sizes, settings.AVATAR_CACHE_TIMEOUT)
+
+
+def cache_result(
+    default_size=settings.AVATAR_DEFAULT_SIZE, key_kwargs=(), prepare=None
+):
     """
     Decorator to cache the result of functions that take a ``user``, a
-    ``width`` and a ``height`` value.
+    ``width`` and a ``height`` value. Results vary with the values of the
+    ``key_kwargs`` keyword arguments too.
+
+    On a cache miss, ``prepare`` is called with the same arguments before the
+    key of the result is computed, to do work which invalidates the user's
+    cache entries, such as creating thumbnails.
     """
     if not settings.AVATAR_CACHE_ENABLED:
 
         def decorator(func):
-            return func
+            if prepare is None:
+                return func
+
+            @wraps(func)
+            def prepared_func(user, width=None, height=None, **kwargs):
+                prepare(user, width or default_size, height, **kwargs)
+                return func(user, width or default_size, height, **kwargs)
+
+            return prepared_func
 
         return decorator
 
     def decorator(func):
+        @wraps(func)
         def cached_func(user, width=None, height=None, **kwargs):
             prefix = func.__name__
+            for name in key_kwargs:
+                prefix += "_%s" % kwargs.get(name, "")
             cached_funcs.add(prefix)
-            key = get_cache_key(user, prefix, width or default_size, height)
+            if local_cache.enabled:
+                local_key = get_local_cache_key(
+                    user, prefix, width or default_size, height
+                )
+                result = local_cache.get(local_key)
+                if result is not None:
+                    cache_stats["local_hits"] += 1
+                    return result
+                cache_stats["local_misses"] += 1
+            key = get_cache_keys([user], prefix, width or default_size, height)[0]
             result = cache.get(key)
             if result is None:
+                cache_stats["shared_misses"] += 1
+                if prepare is not None:
+                    prepare(user, width or default_size, height, **kwargs)
+                    key = get_cache_keys([user], prefix, width or default_size, height)[
+                        0
+                    ]
                 result = func(user, width or default_size, height, **kwargs)
+                # Stored under the generation read before func() ran, so that
+                # a result computed while the user's avatars changed is never
+                # found again.
                 cache_set(key, result)
-                # add image size to set of cached sizes so we can invalidate them later
-                sizes_key = get_cache_key(user, "cached_sizes")
-                sizes = cache.get(sizes_key, set())
-                sizes.add((width or default_size, height or width or default_size))
-                cache_set(sizes_key, sizes)
+                if not settings.AVATAR_CACHE_VERSIONED_KEYS:
+                    # add image size to set of cached sizes so we can invalidate them later
+                    add_cached_size(
+                        [user], width or default_size, height or width or default_size
+                    )
+            else:
+                cache_stats["shared_hits"] += 1
+            if local_cache.enabled:
+                local_cache.set(local_key, result)
             return result
 
         return cached_func
@@ -91,6 +354,32 @@ def invalidate_cache(user, width=None, height=None):
     """
     Function to be called when saving or changing a user's avatars.
     """
+    if local_cache.enabled:
+        local_cache.delete_owner(get_local_cache_owner(user))
+        # Tell the other processes to drop their local entries
+        try:
+            cache.incr(LOCAL_CACHE_STAMP_KEY)
+        except ValueError:
+            cache.set(LOCAL_CACHE_STAMP_KEY, new_cache_generation(), None)
+    # Images streamed by the render_primary view, which accepts either the
+    # username or the primary key of the user, and the size-less has_avatar
+    # entry, which the cached sizes below don't cover.
+    cache.delete_many(
+        [
+            get_cache_key(user, "render_primary"),
+            get_cache_key(str(user.pk), "render_primary"),
+            get_cache_key(user, "has_avatar"),
+        ]
+    )
+    # Moving to a new generation orphans all of the user's versioned entries
+    # and the sprites showing the user.
+    generation_key = get_cache_key(user, "generation")
+    try:
+        cache.incr(generation_key)
+    except ValueError:
+        cache.set(generation_key, new_cache_generation(), None)
+    if settings.AVATAR_CACHE_VERSIONED_KEYS:
+        return
     sizes_key = get_cache_key(user, "cached_sizes")
     sizes = cache.get(sizes_key, set())
     if width is not None:
@@ -125,6 +414,215 @@ def get_default_avatar_url():
     return "%s%s" % (base_url, settings.AVATAR_DEFAULT_URL)
 
 
+def get_thumbnail_task_backend():
+    """
+    Returns the instance of the class configured by
+    ``AVATAR_THUMBNAIL_TASK_BACKEND``.
+    """
+    path = settings.AVATAR_THUMBNAIL_TASK_BACKEND
+    if path not in thumbnail_task_backends:
+        thumbnail_task_backends[path] = import_string(path)()
+    return thumbnail_task_backends[path]
+
+
+@receiver(setting_changed)
+def reset_thumbnail_task_backend(setting, **kwargs):
+    if setting == "AVATAR_THUMBNAIL_TASK_BACKEND":
+        thumbnail_task_backends.clear()
+
+
+def get_image_backend():
+    """
+    Returns the instance of the class configured by ``AVATAR_IMAGE_BACKEND``.
+    """
+    path = settings.AVATAR_IMAGE_BACKEND
+    if path not in image_backends:
+        image_backends[path] = import_string(path)()
+    return image_backends[path]
+
+
+@receiver(setting_changed)
+def reset_image_backend(setting, **kwargs):
+    if setting == "AVATAR_IMAGE_BACKEND":
+        image_backends.clear()
+
+
+@lru_cache(maxsize=None)
+def get_providers():
+    """
+    Returns the ``AVATAR_PROVIDERS`` as a tuple of ``(path, provider)``
+    pairs, imported once and until the setting changes.
+    """
+    providers = []
+    for path in settings.AVATAR_PROVIDERS:
+        provider = import_string(path)
+        if hasattr(provider, "setup"):
+            provider.setup()
+        providers.append((path, provider))
+    return tuple(providers)
+
+
+@receiver(setting_changed)
+def reset_providers(setting, **kwargs):
+    if setting in ("AVATAR_PROVIDERS", "AVATAR_FACEBOOK_GET_ID"):
+        get_providers.cache_clear()
+
+
+@lru_cache(maxsize=None)
+def get_compiled_template(template_name):
+    """
+    Returns the template with the given name, looked up and compiled once per
+    process rather than on every render.
+    """
+    return get_template(template_name)
+
+
+@receiver(setting_changed)
+def reset_compiled_templates(setting, **kwargs):
+    if setting == "TEMPLATES":
+        get_compiled_template.cache_clear()
+
+
+@receiver(file_changed)
+def reload_compiled_templates(file_path, **kwargs):
+    # Edited templates are picked up by the development server
+    get_compiled_template.cache_clear()
+
+
+def get_provider_stats():
+    """
+    Returns how many times each of the providers was called or skipped for
+    users it can't provide an avatar for, and the time spent in its calls.
+    """
+    return {path: dict(stats) for path, stats in provider_stats.items()}
+
+
+def reset_provider_stats():
+    provider_stats.clear()
+
+
+def resolve_avatar_url(user, width=settings.AVATAR_DEFAULT_SIZE, height=None):
+    """
+    Returns the avatar URL of the first of the ``AVATAR_PROVIDERS`` having
+    one for the user, or the default avatar URL.
+    """
+    if height is None:
+        height = width
+    for path, provider in get_providers():
+        stats = provider_stats[path]
+        if hasattr(provider, "can_provide") and not provider.can_provide(user):
+            stats["skips"] += 1
+            continue
+        start = time.perf_counter()
+        avatar_url = provider.get_avatar_url(user, width, height)
+        stats["calls"] += 1
+        stats["seconds"] += time.perf_counter() - start
+        if avatar_url:
+            return avatar_url
+    return get_default_avatar_url()
+
+
+def create_thumbnail_once(avatar, width, height=None):
+    """
+    Creates the thumbnail of the given size if it doesn't exist yet, unless
+    it is pending in the task backend or another request is already creating
+    it, in which case this waits up to ``AVATAR_THUMBNAIL_LOCK_WAIT`` seconds
+    for it. Returns whether the thumbnail exists.
+    """
+    return create_thumbnails_once(avatar, [(width, height or width)])
+
+
+def create_thumbnails_once(avatar, sizes):
+    """
+    Bulk version of create_thumbnail_once(): creates the missing thumbnails
+    of the given sizes with a single decode of the original. Returns whether
+    they all exist.
+    """
+    sizes = normalize_sizes(snap_size(*size) for size in normalize_sizes(sizes))
+    missing = [size for size in sizes if not avatar.thumbnail_exists(*size)]
+    if not missing:
+        return True
+    # Leave pending thumbnails to the task backend
+    if get_thumbnail_task_backend().is_pending(avatar):
+        return False
+    lock_keys = {
+        size: get_cache_key("avatar_%s" % avatar.pk, "thumbnail_lock", *size)
+        for size in missing
+    }
+    locked = [
+        size
+        for size in missing
+        if cache.add(lock_keys[size], 1, settings.AVATAR_THUMBNAIL_LOCK_TIMEOUT)
+    ]
+    if locked:
+        try:
+            avatar.create_thumbnails(locked)
+        finally:
+            cache.delete_many([lock_keys[size] for size in locked])
+    waiting = [lock_keys[size] for size in missing if size not in locked]
+    if not waiting:
+        return True
+    deadline = time.monotonic() + settings.AVATAR_THUMBNAIL_LOCK_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        if not cache.get_many(waiting):
+            # Created by the other requests in the meantime
+            avatar.__dict__.pop("thumbnail_manifest", None)
+            return all(avatar.thumbnail_exists(*size) for size in missing)
+    return False
+
+
+def primary_avatar_prefetch(queryset=None):
+    """
+    Returns a ``Prefetch`` attaching the primary avatar of each user, along
+    with its thumbnail manifest, for instance
+    ``User.objects.prefetch_related(primary_avatar_prefetch())``. The
+    avatars of a ``queryset`` of ``Avatar`` are used when given.
+    """
+    from avatar.models import Avatar
+
+    if queryset is None:
+        queryset = Avatar.objects.prefetch_related("thumbnails")
+    return Prefetch(
+        "avatar_set",
+        queryset=queryset.order_by("-primary", "-date_uploaded")[:1],
+        to_attr=PRIMARY_AVATAR_ATTR,
+    )
+
+
+def prefetch_primary_avatars(users):
+    """
+    Attaches the primary avatar of each of the given users, see
+    ``primary_avatar_prefetch``, and returns them.
+    """
+    prefetch_related_objects(users, primary_avatar_prefetch())
+    return users
+
+
+def get_prefetched_primary_avatar(user):
+    """
+    Returns a list holding the primary avatar of the user attached by
+    ``primary_avatar_prefetch``, an empty list if the user has no avatar or
+    ``None`` if nothing was prefetched.
+    """
+    avatars = getattr(user, PRIMARY_AVATAR_ATTR, None)
+    for avatar in avatars or ():
+        # Sliced prefetches don't link the avatars back to their user
+        avatar.user = user
+    return avatars
+
+
+def get_primary_avatar_id(user):
+    """
+    Returns the primary key of the primary avatar of the user recorded in
+    ``AVATAR_PRIMARY_AVATAR_FIELD``, or ``None``.
+    """
+    field = settings.AVATAR_PRIMARY_AVATAR_FIELD
+    if not field:
+        return None
+    return getattr(user, user._meta.get_field(field).attname)
+
+
 def get_primary_avatar(user, width=settings.AVATAR_DEFAULT_SIZE, height=None):
     User = get_user_model()
     if not isinstance(user, User):
@@ -132,15 +630,342 @@ def get_primary_avatar(user, width=settings.AVATAR_DEFAULT_SIZE, height=None):
             user = get_user(user)
         except User.DoesNotExist:
             return None
-    try:
-        # Order by -primary first; this means if a primary=True avatar exists
-        # it will be first, and then ordered by date uploaded, otherwise a
-        # primary=False avatar will be first.  Exactly the fallback behavior we
-        # want.
-        avatar = user.avatar_set.order_by("-primary", "-date_uploaded")[0]
-    except IndexError:
+    prefetched = get_prefetched_primary_avatar(user)
+    if prefetched is not None:
+        avatar = prefetched[0] if prefetched else None
+    else:
         avatar = None
+        avatar_id = get_primary_avatar_id(user)
+        if avatar_id is not None:
+            avatar = user.avatar_set.filter(pk=avatar_id).first()
+    if avatar is None and prefetched is None:
+        try:
+            # Order by -primary first; this means if a primary=True avatar
+            # exists it will be first, and then ordered by date uploaded,
+            # otherwise a primary=False avatar will be first.  Exactly the
+            # fallback behavior we want.
+            avatar = user.avatar_set.order_by("-primary", "-date_uploaded")[0]
+        except IndexError:
+            avatar = None
     if avatar:
-        if not avatar.thumbnail_exists(width, height):
-            avatar.create_thumbnail(width, height)
+        create_thumbnail_once(avatar, width, height)
     return avatar
+
+
+def get_placeholder(user):
+    """
+    Returns the placeholder of the primary avatar of the given user, as a
+    ``data:`` URI, or an empty string.
+    """
+    User = get_user_model()
+    if not isinstance(user, User):
+        try:
+            user = get_user(user)
+        except User.DoesNotExist:
+            return ""
+    prefetched = get_prefetched_primary_avatar(user)
+    if prefetched is not None:
+        return prefetched[0].placeholder if prefetched else ""
+    placeholders = user.avatar_set.order_by("-primary", "-date_uploaded")
+    return placeholders.values_list("placeholder", flat=True).first() or ""
+
+
+def get_primary_avatars(users, width=settings.AVATAR_DEFAULT_SIZE, height=None):
+    """
+    Bulk version of get_primary_avatar(): returns a dictionary mapping the
+    primary keys of the given users to their primary avatar, using a single
+    query for the avatars and one for their thumbnails. Users without an
+    avatar are left out. Avatars recorded in ``AVATAR_PRIMARY_AVATAR_FIELD``
+    are fetched by primary key, in one more query when some users have none.
+    """
+    from avatar.models import Avatar
+
+    if height is None:
+        height = width
+    primary_avatars = {}
+    missing = []
+    for user in users:
+        prefetched = get_prefetched_primary_avatar(user)
+        if prefetched is None:
+            missing.append(user)
+        elif prefetched:
+            create_thumbnail_once(prefetched[0], width, height)
+            primary_avatars[user.pk] = prefetched[0]
+    users = missing
+    if not users:
+        return primary_avatars
+    avatar_ids = {user.pk: get_primary_avatar_id(user) for user in users}
+    querysets = []
+    recorded = [avatar_id for avatar_id in avatar_ids.values() if avatar_id]
+    if recorded:
+        querysets.append(Avatar.objects.filter(pk__in=recorded))
+    # Users without a recorded primary avatar get their best one
+    unrecorded = [pk for pk, avatar_id in avatar_ids.items() if avatar_id is None]
+    if unrecorded:
+        querysets.append(
+            Avatar.objects.filter(user__in=unrecorded)
+            .annotate(
+                row_number=Window(
+                    RowNumber(),
+                    partition_by=[F("user")],
+                    order_by=[F("primary").desc(), F("date_uploaded").desc()],
+                )
+            )
+            .filter(row_number=1)
+        )
+    users = {user.pk: user for user in users}
+    for queryset in querysets:
+        for avatar in queryset.prefetch_related("thumbnails"):
+            # Avoid fetching the users again
+            avatar.user = users[avatar.user_id]
+            create_thumbnail_once(avatar, width, height)
+            primary_avatars[avatar.user_id] = avatar
+    return primary_avatars
+
+
+def get_has_avatars(users):
+    """
+    Bulk version of the ``has_avatar`` filter: returns a dictionary mapping
+    the primary keys of the given users to whether they have a primary
+    avatar. Prefetched primary avatars (see ``primary_avatar_prefetch``) and
+    cached answers, negative ones included, are used first, the other users
+    are looked up with a single query.
+    """
+    from avatar.models import Avatar
+
+    users = list({user.pk: user for user in users}.values())
+    flags = {}
+    for user in users:
+        prefetched = get_prefetched_primary_avatar(user)
+        if prefetched is not None:
+            flags[user.pk] = bool(prefetched) and prefetched[0].primary
+        elif get_primary_avatar_id(user) is not None:
+            flags[user.pk] = True
+    missing = [user for user in users if user.pk not in flags]
+    use_local_cache = settings.AVATAR_CACHE_ENABLED and local_cache.enabled
+    if use_local_cache and missing:
+        local_flags = {}
+        for user in missing:
+            flag = local_cache.get(get_local_cache_key(user, "has_avatar"))
+            if flag is not None:
+                local_flags[user.pk] = flag
+        cache_stats["local_hits"] += len(local_flags)
+        cache_stats["local_misses"] += len(missing) - len(local_flags)
+        flags.update(local_flags)
+        missing = [user for user in missing if user.pk not in flags]
+    uncached = missing
+    if settings.AVATAR_CACHE_ENABLED and missing:
+        keys = dict(zip(get_cache_keys(missing, "has_avatar"), missing))
+        shared_flags = cache.get_many(keys)
+        for key, flag in shared_flags.items():
+            flags[keys[key].pk] = flag
+        cache_stats["shared_hits"] += len(shared_flags)
+        cache_stats["shared_misses"] += len(keys) - len(shared_flags)
+        missing = [user for user in missing if user.pk not in flags]
+    if missing:
+        with_avatar = set(
+            Avatar.objects.filter(user__in=missing, primary=True).values_list(
+                "user_id", flat=True
+            )
+        )
+        resolved = {user.pk: user.pk in with_avatar for user in missing}
+        if settings.AVATAR_CACHE_ENABLED:
+            # Users without an avatar are cached too, as False
+            cache.set_many(
+                {
+                    key: resolved[user.pk]
+                    for key, user in keys.items()
+                    if user.pk in resolved
+                },
+                settings.AVATAR_CACHE_TIMEOUT,
+            )
+        flags.update(resolved)
+    if use_local_cache:
+        for user in uncached:
+            local_cache.set(get_local_cache_key(user, "has_avatar"), flags[user.pk])
+    return flags
+
+
+def get_avatar_urls(users, width=settings.AVATAR_DEFAULT_SIZE, height=None):
+    """
+    Bulk version of the ``avatar_url`` template tag: returns a dictionary
+    mapping the primary keys of the given users to their avatar URL.
+
+    Cached URLs are fetched at once, the others are resolved by handing all
+    the remaining users to the ``get_avatar_urls`` class method of each of
+    the ``AVATAR_PROVIDERS`` in turn.
+    """
+    if height is None:
+        height = width
+    users = list({user.pk: user for user in users}.values())
+    urls = {}
+    use_local_cache = settings.AVATAR_CACHE_ENABLED and local_cache.enabled
+    if use_local_cache:
+        for user in users:
+            url = local_cache.get(
+                get_local_cache_key(user, "avatar_url", width, height)
+            )
+            if url is not None:
+                urls[user.pk] = url
+        cache_stats["local_hits"] += len(urls)
+        cache_stats["local_misses"] += len(users) - len(urls)
+    local_urls = dict(urls)
+    if settings.AVATAR_CACHE_ENABLED:
+        uncached = [user for user in users if user.pk not in urls]
+        keys = dict(
+            zip(get_cache_keys(uncached, "avatar_url", width, height), uncached)
+        )
+        shared_urls = cache.get_many(keys)
+        for key, url in shared_urls.items():
+            urls[keys[key].pk] = url
+        cache_stats["shared_hits"] += len(shared_urls)
+        cache_stats["shared_misses"] += len(keys) - len(shared_urls)
+    missing = [user for user in users if user.pk not in urls]
+    resolved = {}
+    for path, provider in get_providers():
+        if not missing:
+            break
+        stats = provider_stats[path]
+        candidates = missing
+        if hasattr(provider, "can_provide"):
+            candidates = [user for user in missing if provider.can_provide(user)]
+            stats["skips"] += len(missing) - len(candidates)
+            if not candidates:
+                continue
+        start = time.perf_counter()
+        if hasattr(provider, "get_avatar_urls"):
+            provider_urls = provider.get_avatar_urls(candidates, width, height)
+        else:
+            provider_urls = {
+                user.pk: provider.get_avatar_url(user, width, height)
+                for user in candidates
+            }
+        stats["calls"] += 1
+        stats["seconds"] += time.perf_counter() - start
+        for pk, url in provider_urls.items():
+            if url:
+                resolved[pk] = url
+        missing = [user for user in missing if user.pk not in resolved]
+    for user in missing:
+        resolved[user.pk] = get_default_avatar_url()
+    if settings.AVATAR_CACHE_ENABLED and resolved:
+        cached_funcs.add("avatar_url")
+        cache.set_many(
+            {
+                key: resolved[user.pk]
+                for key, user in keys.items()
+                if user.pk in resolved
+            },
+            settings.AVATAR_CACHE_TIMEOUT,
+        )
+        if not settings.AVATAR_CACHE_VERSIONED_KEYS:
+            add_cached_size(
+                [user for user in users if user.pk in resolved], width, height
+            )
+    urls.update(resolved)
+    if use_local_cache:
+        for user in users:
+            if user.pk not in local_urls:
+                local_cache.set(
+                    get_local_cache_key(user, "avatar_url", width, height),
+                    urls[user.pk],
+                )
+    return urls
+
+
+def get_sprite_version(users, width, height):
+    """
+    Returns a digest of the given users and of the generation of their cache
+    entries, which changes whenever one of their avatars does.
+    """
+    generations = get_cache_generations(users)
+    key = "%sx%s:%s" % (
+        width,
+        height,
+        ",".join(
+            "%s.%s" % (user.pk, generation)
+            for user, generation in zip(users, generations)
+        ),
+    )
+    return hashlib.md5(force_bytes(key)).hexdigest()
+
+
+def get_sprite(users, width=settings.AVATAR_DEFAULT_SIZE, height=None):
+    """
+    Returns the layout of the sprite sheet of the primary avatars of the
+    given users at the given size, as a dictionary with its ``version``, its
+    ``width`` and ``height`` and the ``(x, y)`` ``positions`` of the
+    avatars, keyed by user primary key. Users without an avatar are left
+    out of the sprite.
+
+    Layouts are cached under a key including the generation of each user's
+    cache entries, so that a new avatar only affects the sprites showing it.
+    """
+    if height is None:
+        height = width
+    return _get_sprite(users, width, height)[0]
+
+
+def _get_sprite(users, width, height):
+    """
+    Returns the layout of the sprite, see ``get_sprite``, and the primary
+    avatars of the users if they had to be looked up to build it, ``None``
+    otherwise.
+    """
+    users = list({user.pk: user for user in users}.values())
+    version = get_sprite_version(users, width, height)
+    key = "avatar_sprite_%s" % version
+    sprite = cache.get(key)
+    if sprite is not None:
+        return sprite, None
+    avatars = get_primary_avatars(users, width, height)
+    pks = [user.pk for user in users if user.pk in avatars]
+    columns = max(1, math.ceil(math.sqrt(len(pks))))
+    sprite = {
+        "version": version,
+        "width": columns * width,
+        "height": max(1, math.ceil(len(pks) / columns)) * height,
+        "positions": {
+            pk: ((index % columns) * width, (index // columns) * height)
+            for index, pk in enumerate(pks)
+        },
+    }
+    cache.set(key, sprite, settings.AVATAR_CACHE_TIMEOUT)
+    return sprite, avatars
+
+
+def get_sprite_image(users, width=settings.AVATAR_DEFAULT_SIZE, height=None):
+    """
+    Returns the layout of the sprite sheet of the given users, see
+    ``get_sprite``, and the bytes of its PNG image, which is cached along
+    with the layout.
+    """
+    from PIL import Image
+
+    if height is None:
+        height = width
+    sprite, avatars = _get_sprite(users, width, height)
+    key = "avatar_sprite_image_%s" % sprite["version"]
+    data = cache.get(key)
+    if data is not None:
+        return sprite, data
+    image = Image.new("RGBA", (sprite["width"], sprite["height"]))
+    if avatars is None:
+        avatars = get_primary_avatars(users, width, height)
+    for pk, position in sprite["positions"].items():
+        avatar = avatars.get(pk)
+        if avatar is None or not avatar.thumbnail_exists(width, height):
+            # Pending thumbnails show up once they are created, which moves
+            # the user to a new generation.
+            continue
+        storage = avatar.avatar.storage
+        with storage.open(avatar.avatar_name(*snap_size(width, height)), "rb") as f:
+            thumbnail = Image.open(f)
+            if thumbnail.size != (width, height):
+                thumbnail = thumbnail.resize((width, height))
+            image.paste(thumbnail.convert("RGBA"), position)
+    output = BytesIO()
+    image.save(output, "PNG", optimize=True)
+    data = output.getvalue()
+    cache.set(key, data, settings.AVATAR_CACHE_TIMEOUT)
+    return sprite, data
@@ -0,0 +1,101 @@
+import os
+
+from django.core.exceptions import ValidationError
+from django.template.defaultfilters import filesizeformat
+from django.utils.translation import gettext_lazy as _
+from PIL import Image
+
+from avatar.conf import settings
+from avatar.models import Avatar
+
+# Enough for python-magic to recognize the image formats
+MAGIC_BUFFER_SIZE = 2048
+
+
+def validate_avatar_upload(data, user):
+    """
+    Validates an uploaded avatar for the given user, raising a
+    ``ValidationError`` if it is not acceptable.
+
+    Only the header of the image is read: the image parsed by Django's
+    ``ImageField`` is reused when available and the pixels are never decoded.
+    """
+    if settings.AVATAR_ALLOWED_MIMETYPES:
+        try:
+            import magic
+        except ImportError:
+            raise ImportError(
+                "python-magic library must be installed in order to use uploaded file content limitation"
+            )
+
+        data.seek(0)
+        magic_buffer = data.read(MAGIC_BUFFER_SIZE)
+        data.seek(0)
+
+        # https://github.com/ahupp/python-magic#usage
+        mime = magic.from_buffer(magic_buffer, mime=True)
+        if mime not in settings.AVATAR_ALLOWED_MIMETYPES:
+            raise ValidationError(
+                _(
+                    "File content is invalid. Detected: %(mimetype)s Allowed content types are: %(valid_mime_list)s"
+                )
+                % {
+                    "valid_mime_list": ", ".join(settings.AVATAR_ALLOWED_MIMETYPES),
+                    "mimetype": mime,
+                }
+            )
+
+    if settings.AVATAR_ALLOWED_FILE_EXTS:
+        root, ext = os.path.splitext(data.name.lower())
+        if ext not in settings.AVATAR_ALLOWED_FILE_EXTS:
+            valid_exts = ", ".join(settings.AVATAR_ALLOWED_FILE_EXTS)
+            error = _(
+                "%(ext)s is an invalid file extension. "
+                "Authorized extensions are : %(valid_exts_list)s"
+            )
+            raise ValidationError(error % {"ext": ext, "valid_exts_list": valid_exts})
+
+    if data.size > settings.AVATAR_MAX_SIZE:
+        error = _(
+            "Your file is too big (%(size)s), "
+            "the maximum allowed size is %(max_valid_size)s"
+        )
+        raise ValidationError(
+            error
+            % {
+                "size": filesizeformat(data.size),
+                "max_valid_size": filesizeformat(settings.AVATAR_MAX_SIZE),
+            }
+        )
+
+    image = getattr(data, "image", None)
+    try:
+        if image is None:
+            data.seek(0)
+            image = Image.open(data)
+            data.seek(0)
+        width, height = image.size
+    except (IOError, SyntaxError, TypeError, ValueError, Image.DecompressionBombError):
+        raise ValidationError(_("Corrupted image"))
+    # Decompression bombs are rejected before anything decodes them
+    max_pixels = settings.AVATAR_MAX_PIXELS or Image.MAX_IMAGE_PIXELS
+    if max_pixels and width * height > max_pixels:
+        error = _(
+            "Your image is too large (%(width)dx%(height)d pixels), "
+            "the maximum allowed is %(max_pixels)d pixels."
+        )
+        raise ValidationError(
+            error % {"width": width, "height": height, "max_pixels": max_pixels}
+        )
+
+    max_avatars = settings.AVATAR_MAX_AVATARS_PER_USER
+    if max_avatars > 1:
+        count = Avatar.objects.filter(user=user).count()
+        if count >= max_avatars:
+            error = _(
+                "You already have %(nb_avatars)d avatars, "
+                "and the maximum allowed is %(nb_max_avatars)d."
+            )
+            raise ValidationError(
+                error % {"nb_avatars": count, "nb_max_avatars": max_avatars}
+            )
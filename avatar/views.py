@@ -1,13 +1,35 @@
+import hashlib
+import mimetypes
+from urllib.parse import quote
+
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
+from django.core.cache import cache
+from django.http import FileResponse, Http404, HttpResponse
 from django.shortcuts import redirect, render
+from django.utils.cache import (
+    get_conditional_response,
+    patch_cache_control,
+    patch_vary_headers,
+)
+from django.utils.http import http_date
 from django.utils.translation import gettext as _
 
 from avatar.conf import settings
 from avatar.forms import DeleteAvatarForm, PrimaryAvatarForm, UploadAvatarForm
-from avatar.models import Avatar
+from avatar.models import Avatar, avatar_storage, get_mime_type
 from avatar.signals import avatar_deleted, avatar_updated
-from avatar.utils import get_default_avatar_url, get_primary_avatar, invalidate_cache
+from avatar.utils import (
+    force_bytes,
+    get_allowed_size,
+    get_cache_key,
+    get_default_avatar_url,
+    get_primary_avatar,
+    get_sprite_image,
+    get_sprite_version,
+    get_user_model,
+    invalidate_cache,
+)
 
 
 def _get_next(request):
@@ -35,10 +57,10 @@ def _get_next(request):
 
 def _get_avatars(user):
     # Default set. Needs to be sliced, but that's it. Keep the natural order.
-    avatars = user.avatar_set.all()
+    avatars = user.avatar_set.prefetch_related("thumbnails")
 
     # Current avatar
-    primary_avatar = avatars.order_by("-primary")[:1]
+    primary_avatar = avatars.order_by("-primary", "-date_uploaded")[:1]
     if primary_avatar:
         avatar = primary_avatar[0]
     else:
@@ -173,28 +195,202 @@ def delete(request, extra_context=None, next_override=None, *args, **kwargs):
     return render(request, template_name, context)
 
 
+def _get_accepted_formats(request):
+    """
+    Returns the ``AVATAR_THUMB_EXTRA_FORMATS`` explicitly listed in the
+    ``Accept`` header of the request, followed by ``AVATAR_THUMB_FORMAT``.
+    Media ranges with ``q=0`` are not acceptable.
+    """
+    accepted = set()
+    for media_range in request.headers.get("Accept", "").split(","):
+        mime_type, *params = media_range.split(";")
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value.strip())
+                except ValueError:
+                    pass
+        if quality > 0:
+            accepted.add(mime_type.strip().lower())
+    formats = [
+        format
+        for format in settings.AVATAR_THUMB_EXTRA_FORMATS
+        if get_mime_type(format) in accepted
+    ]
+    return formats + [settings.AVATAR_THUMB_FORMAT]
+
+
+def _get_thumbnail_format(avatar, width, height, formats):
+    """
+    Returns the first of the formats the avatar has a thumbnail in, or
+    ``None`` if it has none.
+    """
+    for format in formats:
+        if avatar.thumbnail_exists(width, height, format):
+            return format
+    return None
+
+
+def _get_primary_rendition(user, width, height, formats):
+    """
+    Returns a dictionary describing the image of the primary avatar of the
+    user streamed by ``render_primary``, or ``None`` if the user has no
+    avatar. Renditions are cached until the user's avatars change, so that
+    revalidations only cost a cache lookup.
+    """
+    key = get_cache_key(user, "render_primary")
+    rendition_key = (width, height, tuple(formats))
+    renditions = {}
+    if settings.AVATAR_CACHE_ENABLED:
+        renditions = cache.get(key) or {}
+        if rendition_key in renditions:
+            return renditions[rendition_key]
+    avatar = get_primary_avatar(user, width=width, height=height)
+    rendition = None
+    if avatar:
+        format = _get_thumbnail_format(avatar, width, height, formats)
+        if format:
+            name = avatar.avatar_name(width, height, format)
+        else:
+            # Thumbnails are still being generated
+            name = avatar.avatar.name
+        version = "%s-%s-%sx%s-%s" % (
+            avatar.pk,
+            avatar.date_uploaded.isoformat(),
+            width,
+            height,
+            name,
+        )
+        rendition = {
+            "name": name,
+            "original": not format,
+            "etag": '"%s"' % hashlib.md5(force_bytes(version)).hexdigest(),
+            "last_modified": int(avatar.date_uploaded.timestamp()),
+        }
+    if settings.AVATAR_CACHE_ENABLED:
+        renditions[rendition_key] = rendition
+        cache.set(key, renditions, settings.AVATAR_CACHE_TIMEOUT)
+    return rendition
+
+
+def _file_response(name):
+    """
+    Returns a response sending the file of the avatar storage, or asking the
+    front-end server to send it as configured by ``AVATAR_SENDFILE_BACKEND``.
+    """
+    backend = settings.AVATAR_SENDFILE_BACKEND
+    if backend == "x-accel-redirect":
+        response = HttpResponse(content_type=mimetypes.guess_type(name)[0])
+        response.headers["X-Accel-Redirect"] = "%s/%s" % (
+            settings.AVATAR_SENDFILE_URL_PREFIX.rstrip("/"),
+            quote(name.replace("\\", "/")),
+        )
+        return response
+    if backend == "x-sendfile":
+        try:
+            path = avatar_storage.path(name)
+        except NotImplementedError:
+            # Not stored on the local filesystem
+            pass
+        else:
+            response = HttpResponse(content_type=mimetypes.guess_type(name)[0])
+            response.headers["X-Sendfile"] = path
+            return response
+    return FileResponse(avatar_storage.open(name, "rb"))
+
+
+def _stream_primary(request, user, width, height):
+    rendition = _get_primary_rendition(
+        user, width, height, _get_accepted_formats(request)
+    )
+    if rendition is None:
+        return redirect(get_default_avatar_url())
+    response = get_conditional_response(
+        request, etag=rendition["etag"], last_modified=rendition["last_modified"]
+    )
+    if response is None:
+        response = _file_response(rendition["name"])
+    response.headers["ETag"] = rendition["etag"]
+    response.headers["Last-Modified"] = http_date(rendition["last_modified"])
+    if rendition.get("original"):
+        # Replaced by the thumbnail once it is created, which has to be
+        # revalidated for.
+        patch_cache_control(response, no_cache=True)
+    else:
+        patch_cache_control(
+            response,
+            public=True,
+            max_age=settings.AVATAR_RENDER_PRIMARY_MAX_AGE,
+            immutable=True,
+        )
+    return response
+
+
 def render_primary(request, user=None, width=settings.AVATAR_DEFAULT_SIZE, height=None):
     if height is None:
         height = width
     width = int(width)
     height = int(height)
-    avatar = get_primary_avatar(user, width=width, height=height)
     if width == 0 and height == 0:
-        avatar = get_primary_avatar(
-            user,
-            width=settings.AVATAR_DEFAULT_SIZE,
-            height=settings.AVATAR_DEFAULT_SIZE,
-        )
+        width = height = settings.AVATAR_DEFAULT_SIZE
+    try:
+        width, height = get_allowed_size(width, height)
+    except ValueError as e:
+        raise Http404(e)
+    if settings.AVATAR_RENDER_PRIMARY_MODE == "stream":
+        response = _stream_primary(request, user, width, height)
     else:
         avatar = get_primary_avatar(user, width=width, height=height)
-    if avatar:
-        # FIXME: later, add an option to render the resized avatar dynamically
-        # instead of redirecting to an already created static file. This could
-        # be useful in certain situations, particulary if there is a CDN and
-        # we want to minimize the storage usage on our static server, letting
-        # the CDN store those files instead
-        url = avatar.avatar_url(width, height)
-    else:
-        url = get_default_avatar_url()
+        if avatar:
+            format = _get_thumbnail_format(
+                avatar, width, height, _get_accepted_formats(request)
+            )
+            url = avatar.avatar_url(width, height, format)
+        else:
+            url = get_default_avatar_url()
+        response = redirect(url)
+    if settings.AVATAR_THUMB_EXTRA_FORMATS:
+        patch_vary_headers(response, ["Accept"])
+    return response
 
-    return redirect(url)
+
+def render_sprite(request, width=settings.AVATAR_DEFAULT_SIZE, height=None):
+    """
+    Renders the sprite sheet of the primary avatars of the users whose
+    comma-separated primary keys are given in the ``users`` parameter, see
+    the ``avatar_sprite`` template tag. The ``v`` parameter must be the
+    current version of the sprite.
+    """
+    if height is None:
+        height = width
+    try:
+        width, height = get_allowed_size(int(width), int(height))
+        pks = [int(pk) for pk in request.GET.get("users", "").split(",") if pk]
+    except ValueError as e:
+        raise Http404(e)
+    if not pks or len(pks) > settings.AVATAR_SPRITE_MAX_USERS:
+        raise Http404(_("Invalid list of users."))
+    if max(width, height) > settings.AVATAR_SPRITE_MAX_SIZE:
+        raise Http404(_("Invalid sprite size."))
+    users = get_user_model().objects.in_bulk(pks)
+    users = list({pk: users[pk] for pk in pks if pk in users}.values())
+    version = get_sprite_version(users, width, height)
+    if request.GET.get("v") != version:
+        # Only the sprites of the template tag are built, and their version
+        # changes along with the avatars they show.
+        raise Http404(_("Invalid sprite version."))
+    etag = '"%s"' % version
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        sprite, data = get_sprite_image(users, width, height)
+        response = HttpResponse(data, content_type="image/png")
+    response.headers["ETag"] = etag
+    patch_cache_control(
+        response,
+        public=True,
+        max_age=settings.AVATAR_RENDER_PRIMARY_MAX_AGE,
+        immutable=True,
+    )
+    return response
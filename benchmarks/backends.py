@@ -0,0 +1,70 @@
+"""
+Compares thumbnail generation with each of the ``AVATAR_IMAGE_BACKEND``
+classes for a 4000x3000 JPEG and PNG, in throughput and peak memory.
+
+Usage::
+
+    python benchmarks/backends.py
+"""
+
+import os
+import sys
+import tempfile
+
+from common import make_image, output, peak_rss_kb, run_isolated, setup_django, timed
+
+REPEAT = 5
+SIZES = (80, 160, (60, 40))
+BACKENDS = (
+    "avatar.imaging.PillowBackend",
+    "avatar.imaging.VipsBackend",
+)
+
+
+def run(path, backend):
+    setup_django(AVATAR_IMAGE_BACKEND=backend)
+    from avatar.conf import settings
+    from avatar.models import thumbnail_formats
+    from avatar.utils import get_image_backend, normalize_sizes
+
+    try:
+        backend = get_image_backend()
+    except ImportError:
+        output("- -")
+        return
+    sizes = normalize_sizes(SIZES)
+
+    def create_thumbnails():
+        with open(path, "rb") as f:
+            backend.create_thumbnails(
+                f, sizes, thumbnail_formats(), settings.AVATAR_THUMB_QUALITY
+            )
+
+    baseline_kb = peak_rss_kb()
+    ms = timed(create_thumbnails, REPEAT)
+    output("%.1f %d" % (1000 / ms, peak_rss_kb() - baseline_kb))
+
+
+def main():
+    output(
+        "%-6s %-30s %12s %16s" % ("format", "backend", "uploads/s", "peak RSS (KiB)")
+    )
+    tmpdir = tempfile.mkdtemp(prefix="avatar-bench-")
+    for format in ("JPEG", "PNG"):
+        path = os.path.join(tmpdir, "photo." + format.lower())
+        # Generate the sample in a child process too, ru_maxrss is inherited
+        # by the processes we spawn.
+        run_isolated(__file__, "make", path, format)
+        for backend in BACKENDS:
+            rate, rss = run_isolated(__file__, path, backend).split()
+            output("%-6s %-30s %12s %16s" % (format, backend, rate, rss))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["make"]:
+        with open(sys.argv[2], "wb") as f:
+            f.write(make_image(format=sys.argv[3]))
+    elif len(sys.argv) == 3:
+        run(*sys.argv[1:])
+    else:
+        main()
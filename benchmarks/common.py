@@ -0,0 +1,95 @@
+"""
+Helpers shared by the benchmark scripts in this directory.
+
+The benchmarks are plain scripts, run them from the repository root, e.g.::
+
+    python benchmarks/thumbnails.py
+"""
+
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_django(**settings):
+    """
+    Configures a minimal Django project using an in-memory database and a
+    temporary ``MEDIA_ROOT``.
+    """
+    sys.path.insert(0, ROOT)
+    import django
+    from django.conf import settings as django_settings
+
+    options = {
+        "DATABASES": {
+            "default": {
+                "ENGINE": "django.db.backends.sqlite3",
+                "NAME": ":memory:",
+            }
+        },
+        "INSTALLED_APPS": [
+            "django.contrib.auth",
+            "django.contrib.contenttypes",
+            "avatar",
+        ],
+        "TEMPLATES": [
+            {
+                "BACKEND": "django.template.backends.django.DjangoTemplates",
+                "APP_DIRS": True,
+            }
+        ],
+        "ROOT_URLCONF": "tests.urls",
+        "MEDIA_ROOT": tempfile.mkdtemp(prefix="avatar-bench-"),
+        "STATIC_URL": "/static/",
+        "SECRET_KEY": "benchmark",
+    }
+    options.update(settings)
+    django_settings.configure(**options)
+    django.setup()
+
+
+def make_image(size=(4000, 3000), format="JPEG", mode="RGB"):
+    """Returns the bytes of a synthetic photo-like image."""
+    from PIL import Image
+
+    image = Image.radial_gradient("L").resize(size).convert(mode)
+    noise = Image.effect_noise(size, 32).convert(mode)
+    image = Image.blend(image, noise, 0.5)
+    data = BytesIO()
+    image.save(data, format, quality=90)
+    return data.getvalue()
+
+
+def output(line):
+    """Writes a line of results to the standard output."""
+    sys.stdout.write(line + "\n")
+
+
+def timed(func, repeat):
+    """Runs ``func`` ``repeat`` times and returns the mean duration in ms."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def peak_rss_kb():
+    """Returns the peak resident set size of this process in KiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_isolated(script, *args):
+    """
+    Runs ``script`` in a fresh interpreter so that peak memory measurements
+    don't leak from one variant into the next. Returns its stripped stdout.
+    """
+    output = subprocess.check_output(
+        [sys.executable, script, *args], cwd=ROOT, text=True
+    )
+    return output.strip()
@@ -0,0 +1,48 @@
+"""
+Compares the size and encoding time of thumbnails in each of the formats
+usable in ``AVATAR_THUMB_FORMAT`` and ``AVATAR_THUMB_EXTRA_FORMATS``, for a
+photo-like image.
+
+Usage::
+
+    python benchmarks/formats.py
+"""
+
+from io import BytesIO
+
+from common import make_image, output, setup_django, timed
+
+REPEAT = 20
+FORMATS = ("PNG", "JPEG", "WEBP", "AVIF")
+SIZES = (80, 160, 320)
+
+
+def main():
+    setup_django()
+    from PIL import Image, features
+
+    from avatar.conf import settings
+    from avatar.imaging import PillowBackend
+
+    backend = PillowBackend()
+    image = Image.open(BytesIO(make_image(size=(1024, 768))))
+    image.load()
+    output("%-6s %6s %10s %14s" % ("format", "size", "bytes", "ms/encode"))
+    for format in FORMATS:
+        if format in ("WEBP", "AVIF") and not features.check(format.lower()):
+            output("%-6s %6s %10s %14s" % (format, "-", "unsupported", "-"))
+            continue
+        for size in SIZES:
+            resized = backend.resize(image, size, size)
+            data = backend.encode(resized, format, settings.AVATAR_THUMB_QUALITY)
+            ms = timed(
+                lambda resized=resized, format=format: backend.encode(
+                    resized, format, settings.AVATAR_THUMB_QUALITY
+                ),
+                REPEAT,
+            )
+            output("%-6s %6s %10d %14.2f" % (format, size, len(data), ms))
+
+
+if __name__ == "__main__":
+    main()
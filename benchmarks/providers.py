@@ -0,0 +1,58 @@
+"""
+Compares the throughput of the ``avatar_url`` template tag, with caching
+disabled, when importing each of the ``AVATAR_PROVIDERS`` on every call
+(the previous implementation) and when going through the provider chain
+loaded once by ``avatar.utils.get_providers``.
+
+Usage::
+
+    python benchmarks/providers.py
+"""
+
+from common import output, setup_django, timed
+
+REPEAT = 20000
+PROVIDERS = (
+    "avatar.providers.GravatarAvatarProvider",
+    "avatar.providers.DefaultAvatarProvider",
+)
+
+
+def import_every_call(user, width, height=None):
+    from django.utils.module_loading import import_string
+
+    from avatar.conf import settings
+    from avatar.utils import get_default_avatar_url
+
+    if height is None:
+        height = width
+    for provider_path in settings.AVATAR_PROVIDERS:
+        provider = import_string(provider_path)
+        avatar_url = provider.get_avatar_url(user, width, height)
+        if avatar_url:
+            return avatar_url
+    return get_default_avatar_url()
+
+
+def main():
+    setup_django(AVATAR_PROVIDERS=PROVIDERS, AVATAR_CACHE_ENABLED=False)
+    from django.contrib.auth.models import User
+
+    from avatar.utils import resolve_avatar_url
+
+    users = {
+        "with email": User(pk=1, username="bench", email="bench@example.org"),
+        "without email": User(pk=2, username="nomail", email=""),
+    }
+    output("%-14s %-18s %12s" % ("user", "implementation", "tags/s"))
+    for label, user in users.items():
+        for name, func in (
+            ("import per call", import_every_call),
+            ("provider chain", resolve_avatar_url),
+        ):
+            ms = timed(lambda func=func, user=user: func(user, 80), REPEAT)
+            output("%-14s %-18s %12.0f" % (label, name, 1000 / ms))
+
+
+if __name__ == "__main__":
+    main()
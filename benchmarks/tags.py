@@ -0,0 +1,61 @@
+"""
+Compares the throughput of the ``avatar`` template tag, with caching
+disabled, when rendering ``avatar/avatar_tag.html`` with ``render_to_string``
+on every call (the previous implementation), with the template compiled once
+per process and with the string formatter used while the default template
+is not overridden (``AVATAR_FAST_TAG_RENDERING``).
+
+Usage::
+
+    python benchmarks/tags.py
+"""
+
+from common import output, setup_django, timed
+
+REPEAT = 5000
+ROUNDS = 5
+PROVIDERS = ("avatar.providers.DefaultAvatarProvider",)
+
+
+def main():
+    setup_django(AVATAR_PROVIDERS=PROVIDERS, AVATAR_CACHE_ENABLED=False)
+    from inspect import unwrap
+    from unittest.mock import patch
+
+    from django.contrib.auth.models import User
+    from django.template.loader import render_to_string
+    from django.test.utils import override_settings
+
+    from avatar.templatetags import avatar_tags
+    from avatar.utils import get_compiled_template
+
+    class RenderToString(object):
+        def render(self, context):
+            return render_to_string(avatar_tags.AVATAR_TAG_TEMPLATE, context)
+
+    def best(func):
+        # The fastest of a few rounds, the others being mostly noise
+        return min(timed(func, REPEAT) for _ in range(ROUNDS))
+
+    user = User(pk=1, username="bench", email="")
+    tag = unwrap(avatar_tags.avatar)
+    kwargs = {"title": "Bench <user>", "class": "avatar"}
+    expected = tag(user, 80, **kwargs)
+    output("%-18s %12s" % ("implementation", "tags/s"))
+    with override_settings(AVATAR_FAST_TAG_RENDERING=False):
+        with patch.object(
+            avatar_tags, "get_compiled_template", lambda name: RenderToString()
+        ):
+            assert tag(user, 80, **kwargs) == expected
+            ms = best(lambda: tag(user, 80, **kwargs))
+        output("%-18s %12.0f" % ("render_to_string", 1000 / ms))
+        get_compiled_template(avatar_tags.AVATAR_TAG_TEMPLATE)
+        assert tag(user, 80, **kwargs) == expected
+        ms = best(lambda: tag(user, 80, **kwargs))
+        output("%-18s %12.0f" % ("compiled template", 1000 / ms))
+    ms = best(lambda: tag(user, 80, **kwargs))
+    output("%-18s %12.0f" % ("string formatter", 1000 / ms))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Compares thumbnail generation with and without decode-time downscaling
+(``AVATAR_RESIZE_REDUCING_GAP``) for a 4000x3000 JPEG and PNG.
+
+Usage::
+
+    python benchmarks/thumbnails.py
+"""
+
+import os
+import sys
+import tempfile
+
+from common import make_image, output, peak_rss_kb, run_isolated, setup_django, timed
+
+REPEAT = 5
+SIZES = (80, 160, (60, 40))
+
+
+def run(path, reducing_gap):
+    setup_django(AVATAR_RESIZE_REDUCING_GAP=reducing_gap)
+    from django.contrib.auth.models import User
+    from django.core.files.base import ContentFile
+    from django.core.management import call_command
+
+    from avatar.models import Avatar
+
+    # Thumbnails are recorded in the database along with the avatar
+    call_command("migrate", verbosity=0)
+    user = User.objects.create(username="bench")
+    avatar = Avatar(user=user)
+    with open(path, "rb") as f:
+        avatar.avatar.save(os.path.basename(path), ContentFile(f.read()), False)
+    avatar.save()
+    baseline_kb = peak_rss_kb()
+    ms = timed(lambda: avatar.create_thumbnails(SIZES), REPEAT)
+    output("%.1f %d" % (ms, peak_rss_kb() - baseline_kb))
+
+
+def main():
+    output(
+        "%-6s %-14s %12s %16s"
+        % ("format", "reducing_gap", "ms/upload", "peak RSS (KiB)")
+    )
+    tmpdir = tempfile.mkdtemp(prefix="avatar-bench-")
+    for format in ("JPEG", "PNG"):
+        path = os.path.join(tmpdir, "photo." + format.lower())
+        # Generate the sample in a child process too, ru_maxrss is inherited
+        # by the processes we spawn.
+        run_isolated(__file__, "make", path, format)
+        for reducing_gap in ("None", "3.0"):
+            ms, rss = run_isolated(__file__, path, reducing_gap).split()
+            output("%-6s %-14s %12s %16s" % (format, reducing_gap, ms, rss))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["make"]:
+        with open(sys.argv[2], "wb") as f:
+            f.write(make_image(format=sys.argv[3]))
+    elif len(sys.argv) == 3:
+        path, reducing_gap = sys.argv[1:]
+        run(path, None if reducing_gap == "None" else float(reducing_gap))
+    else:
+        main()
@@ -0,0 +1,17 @@
+from django.contrib.auth.models import AbstractUser
+from django.db import models
+
+
+class User(AbstractUser):
+    """
+    User model pointing to its primary avatar, for the tests of
+    ``AVATAR_PRIMARY_AVATAR_FIELD``.
+    """
+
+    primary_avatar = models.ForeignKey(
+        "avatar.Avatar",
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name="+",
+    )
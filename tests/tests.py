@@ -1,30 +1,79 @@
+import base64
+import hashlib
 import math
 import os.path
+import struct
 import sys
+import threading
+import time
+from datetime import timedelta
+from inspect import unwrap
+from io import BytesIO, StringIO
 from pathlib import Path
 from shutil import rmtree
+from types import SimpleNamespace
 from unittest import skipIf
+from unittest.mock import patch
 
+import dns.resolver
 from django.contrib.admin.sites import AdminSite
 from django.core import management
 from django.core.cache import cache
-from django.test import TestCase
-from django.test.utils import override_settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.signals import request_started
+from django.db import IntegrityError, connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.template import Context, Template
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.urls import reverse
-from PIL import Image, ImageChops
+from django.utils import timezone
+from django.utils.safestring import mark_safe
+from PIL import Image, ImageChops, ImageFile
+from PIL.JpegImagePlugin import JpegImageFile
 
 from avatar.admin import AvatarAdmin
 from avatar.conf import settings
-from avatar.models import Avatar
+from avatar.forms import UploadAvatarForm
+from avatar.models import (
+    Avatar,
+    AvatarThumbnail,
+    ThumbnailTask,
+    remove_avatar_images,
+)
+from avatar.providers import LibRAvatarProvider, PrimaryAvatarProvider
 from avatar.signals import avatar_deleted
 from avatar.templatetags import avatar_tags
 from avatar.utils import (
+    cache_result,
+    create_thumbnail_once,
+    get_avatar_urls,
     get_cache_key,
+    get_cache_stats,
+    get_default_avatar_url,
+    get_has_avatars,
     get_primary_avatar,
+    get_primary_avatars,
+    get_provider_stats,
+    get_providers,
+    get_sprite_image,
+    get_thumbnail_task_backend,
     get_user_model,
     invalidate_cache,
+    local_cache,
+    prefetch_primary_avatars,
+    primary_avatar_prefetch,
+    reset_cache_stats,
+    reset_provider_stats,
+    resolve_avatar_url,
+    snap_size,
 )
 
+try:
+    import pyvips
+except ImportError:
+    pyvips = None
+
 
 class AssertSignal:
     def __init__(self):
@@ -42,6 +91,27 @@ class AssertSignal:
         self.signal_sent_count += 1
 
 
+class StubResolver:
+    """
+    Answers SRV queries from a dictionary of ``{name: (target, port, ttl)}``.
+    """
+
+    class Answer(list):
+        def __init__(self, target, port, ttl):
+            super().__init__([SimpleNamespace(target=target, port=port)])
+            self.rrset = SimpleNamespace(ttl=ttl)
+
+    def __init__(self, records=None):
+        self.records = records or {}
+        self.queries = []
+
+    def resolve(self, name, rdtype, lifetime=None):
+        self.queries.append((name, rdtype, lifetime))
+        if name not in self.records:
+            raise dns.resolver.NXDOMAIN()
+        return self.Answer(*self.records[name])
+
+
 def upload_helper(o, filename):
     f = open(os.path.join(o.testdatapath, filename), "rb")
     response = o.client.post(
@@ -65,6 +135,46 @@ def root_mean_square_difference(image1, image2):
     return rms
 
 
+def rgb_icc_profile(red, green, blue, gamma=2.2):
+    "Build a minimal matrix/TRC RGB ICC profile from the primaries' XYZ values"
+
+    def xyz(value):
+        return (
+            b"XYZ "
+            + bytes(4)
+            + b"".join(struct.pack(">i", round(v * 65536)) for v in value)
+        )
+
+    white = xyz((0.9642, 1.0, 0.8249))
+    curve = b"curv" + bytes(4) + struct.pack(">IH", 1, round(gamma * 256)) + bytes(2)
+    tags = [
+        (b"wtpt", white),
+        (b"rXYZ", xyz(red)),
+        (b"gXYZ", xyz(green)),
+        (b"bXYZ", xyz(blue)),
+        (b"rTRC", curve),
+        (b"gTRC", curve),
+        (b"bTRC", curve),
+    ]
+    offset = 128 + 4 + 12 * len(tags)
+    table = data = b""
+    for signature, tag in tags:
+        table += signature + struct.pack(">II", offset + len(data), len(tag))
+        data += tag + bytes(-len(tag) % 4)
+    header = (
+        struct.pack(">I", offset + len(data))
+        + bytes(4)
+        + struct.pack(">I", 0x02100000)
+        + b"mntrRGB XYZ "
+        + bytes(12)
+        + b"acsp"
+        + bytes(28)
+        + white[8:]
+        + bytes(48)
+    )
+    return header + struct.pack(">I", len(tags)) + table + data
+
+
 class AvatarTests(TestCase):
     @classmethod
     def setUpClass(cls):
@@ -81,6 +191,9 @@ class AvatarTests(TestCase):
         self.client.login(username="test", password="testpassword")
         self.site = AdminSite()
         Image.init()
+        # Cached avatars of the users of the previous tests, which had the
+        # same usernames and primary keys
+        cache.clear()
 
     def tearDown(self):
         if os.path.exists(self.testmediapath):
@@ -195,6 +308,86 @@ class AvatarTests(TestCase):
         count = Avatar.objects.filter(user=self.user, primary=True).count()
         self.assertEqual(count, 1)
 
+    def test_primary_avatar_constraint(self):
+        self.test_normal_image_upload()
+        self.test_normal_image_upload()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Avatar.objects.filter(user=self.user).update(primary=True)
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(
+                cursor, Avatar._meta.db_table
+            )
+        self.assertIn("avatar_user_primary_idx", constraints)
+
+    def test_primary_avatar_locks_user(self):
+        self.test_normal_image_upload()
+        avatar = Avatar(user=self.user, primary=True, avatar="test.png")
+        with CaptureQueriesContext(connection) as queries:
+            avatar.save()
+        sql = [query["sql"] for query in queries]
+        user_table = get_user_model()._meta.db_table
+        lock = next(
+            i for i, q in enumerate(sql) if q.startswith("SELECT") and user_table in q
+        )
+        demote = next(
+            i for i, q in enumerate(sql) if q.startswith("UPDATE") and "primary" in q
+        )
+        # Concurrent saves for the user wait for this one before demoting
+        self.assertLess(lock, demote)
+        if connection.features.has_select_for_update:
+            self.assertIn("FOR UPDATE", sql[lock])
+        self.assertEqual(
+            list(Avatar.objects.filter(user=self.user, primary=True)), [avatar]
+        )
+
+    @override_settings(AVATAR_PRIMARY_AVATAR_FIELD="primary_avatar")
+    def test_primary_avatar_field(self):
+        User = get_user_model()
+
+        def add_avatar(user, name):
+            with open(os.path.join(self.testdatapath, name), "rb") as f:
+                avatar = Avatar(user=user, primary=True)
+                avatar.avatar.save(name, SimpleUploadedFile(name, f.read()))
+            return avatar
+
+        first = add_avatar(self.user, "test.png")
+        self.assertEqual(User.objects.get(pk=self.user.pk).primary_avatar, first)
+        # Switching the primary avatar moves the pointer, the loaded user too
+        second = add_avatar(self.user, "django.png")
+        self.assertEqual(self.user.primary_avatar_id, second.pk)
+        self.assertEqual(User.objects.get(pk=self.user.pk).primary_avatar, second)
+
+        # Primary avatars are looked up through the pointer
+        other = User.objects.create_user("other", "other@example.com")
+        add_avatar(other, "test.png")
+        User.objects.filter(pk=self.user.pk).update(primary_avatar=first)
+        User.objects.filter(pk=other.pk).update(primary_avatar=None)
+        me, other = User.objects.order_by("pk")
+        self.assertEqual(get_primary_avatar(me), first)
+        self.assertEqual(
+            get_primary_avatars([me, other]),
+            {me.pk: first, other.pk: Avatar.objects.get(user=other)},
+        )
+        with self.assertNumQueries(0):
+            self.assertEqual(get_has_avatars([me]), {me.pk: True})
+        User.objects.filter(pk=self.user.pk).update(primary_avatar=second)
+        self.user.refresh_from_db()
+
+        # Demoting the primary avatar clears the pointer
+        second.primary = False
+        second.save()
+        self.assertIsNone(self.user.primary_avatar_id)
+        self.assertIsNone(User.objects.get(pk=self.user.pk).primary_avatar)
+        # Without a primary avatar, the latest one is used
+        self.assertEqual(get_primary_avatar(User.objects.get(pk=self.user.pk)), second)
+
+        # Deleting the primary avatar clears it as well
+        first.primary = True
+        first.save()
+        self.assertEqual(User.objects.get(pk=self.user.pk).primary_avatar, first)
+        first.delete()
+        self.assertIsNone(User.objects.get(pk=self.user.pk).primary_avatar)
+
     def test_delete_avatar(self):
         self.test_normal_image_upload()
         avatar = Avatar.objects.filter(user=self.user)
@@ -318,12 +511,251 @@ class AvatarTests(TestCase):
 
         self.assertLess(root_mean_square_difference(image_with_exif, image_no_exif), 1)
 
+    def test_create_thumbnails_decodes_original_once(self):
+        upload_helper(self, "test.png")
+        avatar = get_primary_avatar(self.user)
+        with patch("avatar.models.Image.open", wraps=Image.open) as image_open:
+            avatar.create_thumbnails([40, (30, 20), 50, 40])
+        self.assertEqual(image_open.call_count, 1)
+        self.assertMediaFileExists(avatar.avatar_url(40))
+        self.assertMediaFileExists(avatar.avatar_url(30, 20))
+        self.assertMediaFileExists(avatar.avatar_url(50))
+
+    def test_thumbnail_reducing_gap_drafts_jpeg(self):
+        upload_helper(self, "image_no_exif.jpg")
+        avatar = get_primary_avatar(self.user)
+        storage = avatar.avatar.storage
+        with override_settings(AVATAR_RESIZE_REDUCING_GAP=None):
+            avatar.create_thumbnail(10)
+        with storage.open(avatar.avatar_name(10), "rb") as f:
+            exact = Image.open(f)
+            exact.load()
+        storage.delete(avatar.avatar_name(10))
+
+        with patch.object(JpegImageFile, "draft", autospec=True) as draft:
+            avatar.create_thumbnail(10)
+        draft.assert_called_once()
+        # Keep three times the needed pixels: 10 * 3 = 30
+        self.assertEqual(draft.call_args.args[2], (30, 30))
+
+        storage.delete(avatar.avatar_name(10))
+        avatar.create_thumbnail(10)
+        with storage.open(avatar.avatar_name(10), "rb") as f:
+            drafted = Image.open(f)
+            drafted.load()
+        self.assertLess(root_mean_square_difference(exact, drafted), 5)
+
+    @skipIf(pyvips is None, "pyvips is not installed")
+    @override_settings(AVATAR_IMAGE_BACKEND="avatar.imaging.VipsBackend")
+    def test_vips_image_backend(self):
+        upload_helper(self, "image_exif_orientation.jpg")
+        avatar = get_primary_avatar(self.user)
+        storage = avatar.avatar.storage
+        avatar.create_thumbnails([40, (30, 20)], formats=["PNG", "JPEG"])
+        with storage.open(avatar.avatar_name(30, 20, "JPEG"), "rb") as f:
+            image = Image.open(f)
+            image.load()
+        self.assertEqual((image.format, image.size), ("JPEG", (30, 20)))
+        with storage.open(avatar.avatar_name(40), "rb") as f:
+            image_vips = Image.open(f)
+            image_vips.load()
+
+        with override_settings(AVATAR_IMAGE_BACKEND="avatar.imaging.PillowBackend"):
+            avatar.create_thumbnail(40)
+        with storage.open(avatar.avatar_name(40), "rb") as f:
+            image_pillow = Image.open(f)
+            image_pillow.load()
+        self.assertEqual(image_vips.size, (40, 40))
+        self.assertLess(root_mean_square_difference(image_vips, image_pillow), 5)
+
+    @skipIf(pyvips is None, "pyvips is not installed")
+    @override_settings(AVATAR_IMAGE_BACKEND="avatar.imaging.VipsBackend")
+    def test_vips_image_backend_color_conversion(self):
+        upload_helper(self, "django_pony_cmyk.jpg")
+        avatar = get_primary_avatar(self.user)
+        with avatar.avatar.storage.open(avatar.avatar_name(80), "rb") as f:
+            image = Image.open(f)
+            image.load()
+        self.assertIn(image.mode, ("RGB", "RGBA"))
+
     def test_automatic_thumbnail_creation_nondefault_filename(self):
         upload_helper(self, "django #3.png")
         self.assertMediaFileExists(
             f"/avatars/{self.user.id}/resized/80/80/django_3.png"
         )
 
+    def test_get_avatar_urls(self):
+        upload_helper(self, "test.png")
+        avatar = get_primary_avatar(self.user)
+        other = get_user_model().objects.create_user("other", "other@example.com")
+        cache.clear()
+
+        with self.assertNumQueries(2):
+            urls = get_avatar_urls([self.user, other], 80)
+        self.assertEqual(urls[self.user.pk], avatar.avatar_url(80))
+        self.assertEqual(urls[other.pk], avatar_tags.avatar_url(other, 80))
+        # Served from the cache, and shared with the avatar_url tag
+        with self.assertNumQueries(0):
+            self.assertEqual(get_avatar_urls([self.user, other], 80), urls)
+            self.assertEqual(avatar_tags.avatar_url(self.user), urls[self.user.pk])
+
+        invalidate_cache(self.user)
+        with self.assertNumQueries(2):
+            get_avatar_urls([self.user, other], 80)
+
+    def test_avatars_for_tag(self):
+        upload_helper(self, "test.png")
+        avatar = get_primary_avatar(self.user)
+        other = get_user_model().objects.create_user("other", "other@example.com")
+        template = Template(
+            "{% load avatar_tags %}{% avatars_for users 80 as urls %}"
+            "{% for user, url in urls %}{{ user.username }}={{ url }};{% endfor %}"
+        )
+        result = template.render(Context({"users": [self.user, other]}))
+        self.assertTrue(
+            result.startswith("test=%s;other=" % avatar.avatar_url(80)), result
+        )
+
+    def test_avatar_sprite(self):
+        upload_helper(self, "test.png")
+        User = get_user_model()
+        other = User.objects.create_user("other", "other@example.com")
+        with open(os.path.join(self.testdatapath, "django.png"), "rb") as f:
+            avatar = Avatar(user=other, primary=True)
+            avatar.avatar.save("django.png", SimpleUploadedFile("django.png", f.read()))
+        nobody = User.objects.create_user("nobody", "nobody@example.com")
+
+        sprite = avatar_tags.avatar_sprite([self.user, nobody, other], 80)
+        self.assertEqual((sprite["width"], sprite["height"]), (80, 80))
+        me, no, you = sprite["avatars"]
+        self.assertEqual((me["x"], me["y"], you["x"], you["y"]), (0, 0, 80, 0))
+        self.assertIn("background: url(%s) -80px 0px" % sprite["url"], you["style"])
+        self.assertEqual(no["url"], avatar_tags.avatar_url(nobody, 80))
+        self.assertEqual(no["style"], "")
+
+        response = self.client.get(sprite["url"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertIn("immutable", response["Cache-Control"])
+        image = Image.open(BytesIO(response.content))
+        self.assertEqual(image.size, (160, 80))
+        with avatar.avatar.storage.open(avatar.avatar_name(80), "rb") as f:
+            thumbnail = Image.open(f).convert("RGBA")
+        self.assertEqual(image.getpixel((120, 40)), thumbnail.getpixel((40, 40)))
+        response = self.client.get(
+            sprite["url"], headers={"if-none-match": response["ETag"]}
+        )
+        self.assertEqual(response.status_code, 304)
+
+        # Only the sprites showing the user are rebuilt
+        alone = avatar_tags.avatar_sprite([self.user], 80)
+        invalidate_cache(other)
+        self.assertEqual(avatar_tags.avatar_sprite([self.user], 80), alone)
+        self.assertNotEqual(
+            avatar_tags.avatar_sprite([self.user, nobody, other], 80)["url"],
+            sprite["url"],
+        )
+
+        # Outdated or made up versions aren't rendered
+        self.assertEqual(self.client.get(sprite["url"]).status_code, 404)
+        sprite = avatar_tags.avatar_sprite([self.user, nobody, other], 80)
+        self.assertEqual(self.client.get(sprite["url"]).status_code, 200)
+        for version in ("", "0" * 32):
+            url = sprite["url"].replace(sprite["url"].rsplit("v=", 1)[1], version)
+            self.assertEqual(self.client.get(url).status_code, 404)
+        url = reverse("avatar:render_sprite", kwargs={"width": 80, "height": 80})
+        response = self.client.get(url, {"users": "%s,%s" % (other.pk, self.user.pk)})
+        self.assertEqual(response.status_code, 404)
+
+        with override_settings(AVATAR_SPRITE_MAX_USERS=1):
+            self.assertEqual(self.client.get(sprite["url"]).status_code, 404)
+        with override_settings(AVATAR_SPRITE_MAX_USERS=2):
+            many = avatar_tags.avatar_sprite([self.user, nobody, other], 80)
+            self.assertEqual(many["url"], "")
+            self.assertEqual(
+                [avatar["url"] for avatar in many["avatars"]],
+                [
+                    avatar_tags.avatar_url(self.user, 80),
+                    avatar_tags.avatar_url(nobody, 80),
+                    avatar_tags.avatar_url(other, 80),
+                ],
+            )
+        with override_settings(AVATAR_SPRITE_MAX_SIZE=40):
+            self.assertEqual(self.client.get(sprite["url"]).status_code, 404)
+            large = avatar_tags.avatar_sprite([self.user, other], 80)
+            self.assertEqual(large["url"], "")
+            self.assertEqual(
+                [avatar["url"] for avatar in large["avatars"]],
+                [
+                    avatar_tags.avatar_url(self.user, 80),
+                    avatar_tags.avatar_url(other, 80),
+                ],
+            )
+
+    def test_avatar_sprite_image_queries(self):
+        upload_helper(self, "test.png")
+        cache.clear()
+        with patch(
+            "avatar.utils.get_primary_avatars", side_effect=get_primary_avatars
+        ) as primary_avatars:
+            get_sprite_image([self.user], 80)
+        primary_avatars.assert_called_once()
+
+    def test_avatar_srcset_tag(self):
+        upload_helper(self, "test.png")
+        avatar = Avatar.objects.get(user=self.user)
+        template = Template(
+            '{% load avatar_tags %}{% avatar_srcset user 40 densities="1,2,3" %}'
+        )
+        with patch(
+            "avatar.models.Avatar.create_thumbnails",
+            autospec=True,
+            side_effect=Avatar.create_thumbnails,
+        ) as create_thumbnails:
+            result = template.render(Context({"user": self.user}))
+        # All the densities come from a single batch
+        create_thumbnails.assert_called_once()
+        self.assertInHTML(
+            '<img src="%s" width="40" height="40" alt="User Avatar" '
+            'srcset="%s 1x, %s 2x, %s 3x" />'
+            % (
+                avatar.avatar_url(40),
+                avatar.avatar_url(40),
+                avatar.avatar_url(80),
+                avatar.avatar_url(120),
+            ),
+            result,
+        )
+        # Cached as a whole, per set of densities
+        with self.assertNumQueries(0):
+            self.assertEqual(template.render(Context({"user": self.user})), result)
+        self.assertNotIn(
+            "3x", avatar_tags.avatar_srcset(self.user, 40, densities="1,2")
+        )
+
+    def test_primary_avatar_prefetch(self):
+        upload_helper(self, "test.png")
+        avatar = Avatar.objects.select_related("user").get(user=self.user)
+        User = get_user_model()
+        User.objects.create_user("other", "other@example.com")
+        cache.clear()
+        with self.assertNumQueries(3):
+            users = list(
+                User.objects.order_by("pk").prefetch_related(primary_avatar_prefetch())
+            )
+        me, other = users
+        with self.assertNumQueries(0):
+            self.assertEqual(get_primary_avatar(me), avatar)
+            self.assertIsNone(get_primary_avatar(other))
+            self.assertTrue(avatar_tags.has_avatar(me))
+            self.assertFalse(avatar_tags.has_avatar(other))
+            self.assertEqual(resolve_avatar_url(me, 80), avatar.avatar_url(80))
+            self.assertEqual(get_avatar_urls(users, 80)[me.pk], avatar.avatar_url(80))
+
+        other = prefetch_primary_avatars([User.objects.get(username="other")])[0]
+        with self.assertNumQueries(0):
+            self.assertFalse(avatar_tags.has_avatar(other))
+
     def test_has_avatar_False_if_no_avatar(self):
         self.assertFalse(avatar_tags.has_avatar(self.user))
 
@@ -335,6 +767,40 @@ class AvatarTests(TestCase):
 
         self.assertTrue(avatar_tags.has_avatar(self.user))
 
+    def test_has_avatar_cached(self):
+        cache.clear()
+        with self.assertNumQueries(1):
+            self.assertFalse(avatar_tags.has_avatar(self.user))
+        with self.assertNumQueries(0):
+            self.assertFalse(avatar_tags.has_avatar(self.user))
+        upload_helper(self, "test.png")
+        with self.assertNumQueries(1):
+            self.assertTrue(avatar_tags.has_avatar(self.user))
+        with self.assertNumQueries(0):
+            self.assertTrue(avatar_tags.has_avatar(self.user))
+
+    @override_settings(AVATAR_CACHE_VERSIONED_KEYS=False)
+    def test_has_avatar_cached_legacy_keys(self):
+        cache.clear()
+        self.assertFalse(avatar_tags.has_avatar(self.user))
+        upload_helper(self, "test.png")
+        self.assertTrue(avatar_tags.has_avatar(self.user))
+        Avatar.objects.get(user=self.user).delete()
+        self.assertFalse(avatar_tags.has_avatar(self.user))
+
+    def test_has_avatars(self):
+        upload_helper(self, "test.png")
+        other = get_user_model().objects.create_user("other", "other@example.com")
+        cache.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                get_has_avatars([self.user, other]),
+                {self.user.pk: True, other.pk: False},
+            )
+        with self.assertNumQueries(0):
+            self.assertTrue(avatar_tags.has_avatar(self.user))
+            self.assertFalse(avatar_tags.has_avatar(other))
+
     def test_avatar_tag_works_with_username(self):
         upload_helper(self, "test.png")
         avatar = get_primary_avatar(self.user)
@@ -391,6 +857,38 @@ class AvatarTests(TestCase):
         )
         self.assertInHTML(html, result)
 
+    def test_avatar_tag_fast_path(self):
+        render = unwrap(avatar_tags.avatar)
+        kwargs = {
+            "title": 'Joe "the" <b>User</b> & co',
+            "class": mark_safe("avatar &amp; round"),
+            "data-rank": 1000,
+            "data-none": None,
+        }
+        with override_settings(AVATAR_FAST_TAG_RENDERING=False):
+            expected = render(self.user, 1000, 48, **kwargs)
+        self.assertEqual(render(self.user, 1000, 48, **kwargs), expected)
+        self.assertIn('title="Joe &quot;the&quot; &lt;b&gt;User', expected)
+        self.assertIn('class="avatar &amp; round"', expected)
+        with patch.object(avatar_tags, "format_avatar_tag") as format_avatar_tag:
+            with override_settings(AVATAR_FAST_TAG_RENDERING=False):
+                render(self.user)
+            format_avatar_tag.assert_not_called()
+            render(self.user)
+            format_avatar_tag.assert_called_once()
+
+    def test_avatar_tag_overridden_template(self):
+        templates_dir = Path(self.testmediapath) / "templates"
+        (templates_dir / "avatar").mkdir(parents=True)
+        (templates_dir / "avatar" / "avatar_tag.html").write_text(
+            '<img class="custom" src="{{ url }}" />'
+        )
+        templates = [dict(settings.TEMPLATES[0], DIRS=[str(templates_dir)])]
+        with override_settings(TEMPLATES=templates):
+            result = unwrap(avatar_tags.avatar)(self.user)
+        self.assertTrue(result.startswith('<img class="custom" src="'))
+        self.assertNotIn("custom", unwrap(avatar_tags.avatar)(self.user))
+
     def test_primary_avatar_tag_works(self):
         upload_helper(self, "test.png")
 
@@ -513,6 +1011,237 @@ class AvatarTests(TestCase):
         self.assertMediaFileExists(avatar_80_url)
         self.assertNotEqual(avatar_80_mtime, self.get_media_file_mtime(avatar_80_url))
 
+    def test_rebuild_avatars_only_missing(self):
+        upload_helper(self, "test.png")
+        avatar = get_primary_avatar(self.user)
+        avatar_51_url = avatar.avatar_url(51)
+        avatar_80_url = avatar.avatar_url(80)
+        avatar_80_mtime = self.get_media_file_mtime(avatar_80_url)
+        avatar.avatar.storage.delete(avatar.avatar_name(51))
+        avatar.thumbnails.filter(width=51).delete()
+
+        management.call_command("rebuild_avatars", only_missing=True, verbosity=0)
+        self.assertMediaFileExists(avatar_51_url)
+        self.assertEqual(avatar_80_mtime, self.get_media_file_mtime(avatar_80_url))
+
+    def test_rebuild_avatars_resumes_from_checkpoint(self):
+        upload_helper(self, "test.png")
+        upload_helper(self, "django.png")
+        first, second = Avatar.objects.order_by("pk")
+        first_mtime = self.get_media_file_mtime(first.avatar_url(80))
+        second_mtime = self.get_media_file_mtime(second.avatar_url(80))
+        checkpoint = os.path.join(self.testmediapath, "rebuild.checkpoint")
+        with open(checkpoint, "w") as f:
+            f.write(str(first.pk))
+
+        out = StringIO()
+        management.call_command(
+            "rebuild_avatars", checkpoint=checkpoint, chunk_size=1, stdout=out
+        )
+        self.assertIn("Resuming after Avatar id=%s." % first.pk, out.getvalue())
+        self.assertIn("Rebuilt 1 avatars, up to id=%s" % second.pk, out.getvalue())
+        self.assertEqual(first_mtime, self.get_media_file_mtime(first.avatar_url(80)))
+        self.assertNotEqual(
+            second_mtime, self.get_media_file_mtime(second.avatar_url(80))
+        )
+        self.assertFalse(os.path.exists(checkpoint))
+
+    def test_rebuild_avatars_id_range(self):
+        upload_helper(self, "test.png")
+        upload_helper(self, "django.png")
+        first, second = Avatar.objects.order_by("pk")
+        first_mtime = self.get_media_file_mtime(first.avatar_url(80))
+        second_mtime = self.get_media_file_mtime(second.avatar_url(80))
+
+        management.call_command(
+            "rebuild_avatars", id_range=(first.pk, first.pk), verbosity=0
+        )
+        self.assertNotEqual(
+            first_mtime, self.get_media_file_mtime(first.avatar_url(80))
+        )
+        self.assertEqual(second_mtime, self.get_media_file_mtime(second.avatar_url(80)))
+
+    def test_thumbnail_manifest(self):
+        upload_helper(self, "test.png")
+        avatar = Avatar.objects.get(user=self.user)
+        thumbnail = AvatarThumbnail.objects.get(avatar=avatar, width=80, height=80)
+        self.assertEqual(thumbnail.format, "PNG")
+        with avatar.avatar.storage.open(avatar.avatar_name(80), "rb") as f:
+            data = f.read()
+        self.assertEqual(thumbnail.size, len(data))
+        self.assertEqual(thumbnail.checksum, hashlib.md5(data).hexdigest())
+
+        with patch.object(avatar.avatar.storage, "exists") as exists:
+            self.assertTrue(avatar.thumbnail_exists(80))
+            self.assertTrue(avatar.thumbnail_exists(33, 22))
+        exists.assert_not_called()
+
+        # Thumbnails missing from the manifest are looked up in the storage
+        avatar.thumbnails.filter(width=80).delete()
+        del avatar.thumbnail_manifest
+        with override_settings(AVATAR_THUMBNAIL_STORAGE_FALLBACK=False):
+            with patch.object(avatar.avatar.storage, "exists") as exists:
+                self.assertFalse(avatar.thumbnail_exists(80))
+            exists.assert_not_called()
+        self.assertTrue(avatar.thumbnail_exists(80))
+        self.assertTrue(avatar.thumbnails.filter(width=80).exists())
+
+        remove_avatar_images(avatar, delete_main_avatar=False)
+        self.assertFalse(avatar.thumbnails.exists())
+        self.assertFalse(avatar.thumbnail_exists(80))
+
+    def test_thumbnail_manifest_replaced_image(self):
+        upload_helper(self, "test.png")
+        avatar = Avatar.objects.get(user=self.user)
+        self.assertTrue(avatar.thumbnail_exists(80))
+        with open(os.path.join(self.testdatapath, "django.png"), "rb") as f:
+            avatar.avatar.save("django.png", SimpleUploadedFile("django.png", f.read()))
+        self.assertFalse(avatar.thumbnails.exists())
+        self.assertFalse(avatar.thumbnail_exists(80))
+        # Created again on demand from the new image
+        self.assertEqual(get_primary_avatar(self.user, 80), avatar)
+        self.assertTrue(avatar.avatar.storage.exists(avatar.avatar_name(80)))
+        self.assertEqual(avatar_tags.avatar_url(self.user), avatar.avatar_url(80))
+
+    def test_reconcile_avatar_thumbnails(self):
+        upload_helper(self, "test.png")
+        avatar = Avatar.objects.get(user=self.user)
+        avatar.thumbnails.filter(width=80).delete()
+        avatar.avatar.storage.delete(avatar.avatar_name(51))
+
+        management.call_command(
+            "reconcile_avatar_thumbnails", checksums=True, verbosity=0
+        )
+        self.assertEqual(
+            set(avatar.thumbnails.values_list("width", "height", "format")),
+            {(80, 80, "PNG"), (62, 62, "PNG"), (33, 22, "PNG")},
+        )
+        self.assertFalse(avatar.thumbnails.filter(checksum="").exists())
+
+    def test_placeholder(self):
+        upload_helper(self, "test.png")
+        avatar = Avatar.objects.get(user=self.user)
+        prefix = "data:image/webp;base64,"
+        self.assertTrue(avatar.placeholder.startswith(prefix))
+        data = base64.b64decode(avatar.placeholder.split(",", 1)[1])
+        self.assertLess(len(data), 200)
+        self.assertEqual(Image.open(BytesIO(data)).size, (8, 8))
+
+        # Cached apart from the tag without a placeholder
+        self.assertNotIn("background", avatar_tags.avatar(self.user))
+        result = avatar_tags.avatar(self.user, placeholder=True, style="border: 0")
+        self.assertIn(
+            'style="background: url(%s) center / cover; border: 0"'
+            % avatar.placeholder,
+            result,
+        )
+        self.assertNotIn("background", avatar_tags.avatar_picture(self.user, 40))
+        self.assertIn(
+            "background", avatar_tags.avatar_picture(self.user, 40, placeholder=True)
+        )
+
+        # Changing the image drops the stale placeholder
+        with open(os.path.join(self.testdatapath, "django.png"), "rb") as f:
+            avatar.avatar.save("django.png", SimpleUploadedFile("django.png", f.read()))
+        self.assertEqual(Avatar.objects.get(pk=avatar.pk).placeholder, "")
+
+    def test_create_avatar_placeholders(self):
+        upload_helper(self, "test.png")
+        avatar = Avatar.objects.get(user=self.user)
+        Avatar.objects.update(placeholder="")
+        with override_settings(AVATAR_PLACEHOLDER_FORMAT="PNG"):
+            management.call_command("create_avatar_placeholders", verbosity=0)
+        avatar.refresh_from_db()
+        self.assertTrue(avatar.placeholder.startswith("data:image/png;base64,"))
+        # Existing placeholders are kept unless --all is given
+        management.call_command("create_avatar_placeholders", verbosity=0)
+        avatar.refresh_from_db()
+        self.assertTrue(avatar.placeholder.startswith("data:image/png;base64,"))
+        management.call_command("create_avatar_placeholders", all=True, verbosity=0)
+        avatar.refresh_from_db()
+        self.assertTrue(avatar.placeholder.startswith("data:image/webp;base64,"))
+
+    @override_settings(AVATAR_THUMBNAIL_TASK_BACKEND="avatar.tasks.DatabaseBackend")
+    def test_database_thumbnail_task_backend(self):
+        upload_helper(self, "test.png")
+        avatar = Avatar.objects.get(user=self.user)
+        self.assertEqual(ThumbnailTask.objects.filter(avatar=avatar).count(), 1)
+        self.assertFalse(avatar.thumbnail_exists(80))
+        # The original is used while the thumbnails are pending
+        self.assertEqual(avatar_tags.avatar_url(self.user), avatar.avatar.url)
+        self.assertFalse(avatar.thumbnail_exists(80))
+
+        management.call_command("process_avatar_thumbnails", verbosity=0)
+        self.assertFalse(ThumbnailTask.objects.exists())
+        self.assertTrue(avatar.thumbnail_exists(80))
+        self.assertTrue(avatar.thumbnail_exists(33, 22))
+        self.assertEqual(avatar_tags.avatar_url(self.user), avatar.avatar_url(80))
+        # The task queue isn't looked up for thumbnails which exist
+        other = get_user_model().objects.create_user("other", "other@example.com")
+        cache.clear()
+        with self.assertNumQueries(2):
+            urls = get_avatar_urls([self.user, other], 80)
+        self.assertEqual(urls[self.user.pk], avatar.avatar_url(80))
+
+    @override_settings(AVATAR_THUMBNAIL_TASK_BACKEND="avatar.tasks.DatabaseBackend")
+    def test_database_thumbnail_task_backend_failure(self):
+        upload_helper(self, "test.png")
+        other = get_user_model().objects.create_user("other", "other@example.com")
+        with open(os.path.join(self.testdatapath, "django.png"), "rb") as f:
+            Avatar(user=other, primary=True).avatar.save(
+                "django.png", SimpleUploadedFile("django.png", f.read())
+            )
+        failing, avatar = Avatar.objects.order_by("pk")
+        create_thumbnails = Avatar.create_thumbnails
+
+        def fail_first(self, sizes):
+            if self.pk == failing.pk:
+                raise Image.DecompressionBombError("Too large")
+            create_thumbnails(self, sizes)
+
+        with patch("avatar.models.Avatar.create_thumbnails", fail_first):
+            management.call_command("process_avatar_thumbnails", verbosity=0)
+        # The other task went through and the failed one is not retried
+        self.assertTrue(avatar.thumbnail_exists(80))
+        task = ThumbnailTask.objects.get()
+        self.assertEqual(task.avatar, failing)
+        self.assertIn("Too large", task.error)
+        self.assertFalse(get_thumbnail_task_backend().is_pending(failing))
+        self.assertEqual(get_thumbnail_task_backend().process(), 0)
+
+    @override_settings(AVATAR_THUMBNAIL_TASK_BACKEND="avatar.tasks.DatabaseBackend")
+    def test_database_thumbnail_task_backend_stale_claims(self):
+        upload_helper(self, "test.png")
+        backend = get_thumbnail_task_backend()
+        self.assertEqual(len(backend.claim()), 1)
+        # Claimed by another worker
+        self.assertEqual(backend.claim(), [])
+        ThumbnailTask.objects.update(
+            date_claimed=timezone.now() - timedelta(seconds=backend.claim_timeout + 1)
+        )
+        self.assertEqual(backend.process(), 1)
+        self.assertFalse(ThumbnailTask.objects.exists())
+
+    @override_settings(
+        AVATAR_THUMBNAIL_TASK_BACKEND="avatar.tasks.DatabaseBackend",
+        AVATAR_PENDING_USE_ORIGINAL=False,
+    )
+    @patch.object(LibRAvatarProvider, "resolver", StubResolver())
+    def test_pending_thumbnails_fall_back_to_next_provider(self):
+        upload_helper(self, "test.png")
+        self.assertIn("libravatar", avatar_tags.avatar_url(self.user))
+
+    @override_settings(AVATAR_THUMBNAIL_TASK_BACKEND="avatar.tasks.ThreadPoolBackend")
+    def test_thread_pool_thumbnail_task_backend(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            upload_helper(self, "test.png")
+        get_thumbnail_task_backend().executor.shutdown(wait=True)
+        avatar = Avatar.objects.get(user=self.user)
+        self.assertFalse(get_thumbnail_task_backend().is_pending(avatar))
+        self.assertTrue(avatar.thumbnail_exists(80))
+        self.assertTrue(avatar.thumbnail_exists(33, 22))
+
+    @override_settings(AVATAR_CACHE_VERSIONED_KEYS=False)
     def test_invalidate_cache(self):
         upload_helper(self, "test.png")
         sizes_key = get_cache_key(self.user, "cached_sizes")
@@ -533,3 +1262,516 @@ class AvatarTests(TestCase):
         sizes = cache.get(sizes_key, set())
         # It should now be empty again
         self.assertEqual(len(sizes), 0)
+
+    def test_invalidate_cache_concurrent_writers(self):
+        calls = []
+
+        @cache_result()
+        def render(user, width, height):
+            calls.append(width)
+            return "%s:%s" % (user.pk, width)
+
+        sizes = range(10, 90, 10)
+        threads = [
+            threading.Thread(target=render, args=(self.user, size)) for size in sizes
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(calls), list(sizes))
+        for size in sizes:
+            render(self.user, size)
+        self.assertEqual(len(calls), len(sizes))
+        # Every size cached by any of the threads is gone at once
+        invalidate_cache(self.user)
+        for size in sizes:
+            self.assertEqual(render(self.user, size), "%s:%s" % (self.user.pk, size))
+        self.assertEqual(len(calls), 2 * len(sizes))
+
+    def test_invalidate_cache_interleaved_with_write(self):
+        value = "old"
+        rendering = threading.Event()
+        invalidated = threading.Event()
+
+        @cache_result()
+        def render_interleaved(user, width, height):
+            result = value
+            if threading.current_thread() is not threading.main_thread():
+                rendering.set()
+                invalidated.wait(5)
+            return result
+
+        # A render computes the old value, the avatar changes and then the
+        # render writes the old value to the cache
+        thread = threading.Thread(target=render_interleaved, args=(self.user,))
+        thread.start()
+        self.assertTrue(rendering.wait(5))
+        value = "new"
+        invalidate_cache(self.user)
+        invalidated.set()
+        thread.join()
+        self.assertEqual(render_interleaved(self.user), "new")
+
+    def test_cache_result_invalidated_during_render(self):
+        values = ["old", "new"]
+
+        @cache_result()
+        def render_invalidated(user, width, height):
+            value = values.pop(0)
+            if value == "old":
+                # The avatar changes while the old result is being computed
+                invalidate_cache(user)
+            return value
+
+        self.assertEqual(render_invalidated(self.user), "old")
+        self.assertEqual(render_invalidated(self.user), "new")
+        self.assertEqual(render_invalidated(self.user), "new")
+
+    @override_settings(AVATAR_LOCAL_CACHE_SIZE=2)
+    def test_local_cache(self):
+        reset_cache_stats()
+        url = avatar_tags.avatar_url(self.user)
+        self.assertEqual(avatar_tags.avatar_url(self.user), url)
+        self.assertEqual(
+            get_cache_stats(),
+            {"local_hits": 1, "local_misses": 1, "shared_hits": 0, "shared_misses": 1},
+        )
+        # Least recently used entries are evicted
+        avatar_tags.avatar_url(self.user, 40)
+        avatar_tags.avatar_url(self.user, 20)
+        self.assertEqual(len(local_cache.entries), 2)
+        self.assertIsNone(local_cache.get((self.user.username, "avatar_url", 80, 80)))
+        # Uploading an avatar invalidates the local entries of the user
+        upload_helper(self, "test.png")
+        self.assertNotEqual(avatar_tags.avatar_url(self.user), url)
+
+    @override_settings(AVATAR_LOCAL_CACHE_SIZE=10)
+    def test_local_cache_invalidated_by_other_process(self):
+        request_started.send(sender=None)
+        avatar_tags.avatar_url(self.user)
+        get_avatar_urls([self.user], 40)
+        self.assertEqual(len(local_cache.entries), 2)
+        request_started.send(sender=None)
+        self.assertEqual(len(local_cache.entries), 2)
+        # Another process invalidates the cache of one of its users
+        cache.set("avatar_local_cache_stamp", 1, None)
+        request_started.send(sender=None)
+        self.assertEqual(len(local_cache.entries), 0)
+
+    def test_libravatar_dns_lookups_are_cached_per_domain(self):
+        resolver = StubResolver(
+            {"_avatars._tcp.example.org": ("avatars.example.org.", 443, 600)}
+        )
+        users = [
+            get_user_model().objects.create_user("user%s" % i, "u%s@Example.org" % i)
+            for i in range(5)
+        ]
+        with patch.object(LibRAvatarProvider, "resolver", resolver):
+            urls = LibRAvatarProvider.get_avatar_urls(users, 80)
+            self.assertEqual(
+                LibRAvatarProvider.get_avatar_url(users[0], 80), urls[users[0].pk]
+            )
+        self.assertEqual(
+            resolver.queries,
+            [
+                (
+                    "_avatars._tcp.example.org",
+                    "SRV",
+                    settings.AVATAR_LIBRAVATAR_DNS_LIFETIME,
+                )
+            ],
+        )
+        self.assertEqual(resolver.timeout, settings.AVATAR_LIBRAVATAR_DNS_TIMEOUT)
+        for user in users:
+            self.assertTrue(
+                urls[user.pk].startswith("https://avatars.example.org/avatar/")
+            )
+
+    def test_libravatar_dns_lookups_cache_nxdomain(self):
+        cache.clear()
+        resolver = StubResolver()
+        with patch.object(LibRAvatarProvider, "resolver", resolver):
+            url = LibRAvatarProvider.get_avatar_url(self.user, 80)
+            LibRAvatarProvider.get_avatar_url(self.user, 80)
+        self.assertEqual(len(resolver.queries), 1)
+        self.assertTrue(url.startswith(LibRAvatarProvider.default_base_url))
+        self.assertIn(hashlib.md5(self.user.email.encode()).hexdigest(), url)
+
+    @override_settings(
+        AVATAR_PROVIDERS=(
+            "avatar.providers.GravatarAvatarProvider",
+            "avatar.providers.DefaultAvatarProvider",
+        ),
+    )
+    def test_provider_chain(self):
+        self.assertIs(get_providers(), get_providers())
+        self.assertEqual(
+            [path for path, provider in get_providers()],
+            list(settings.AVATAR_PROVIDERS),
+        )
+        reset_provider_stats()
+        self.assertIn("gravatar", resolve_avatar_url(self.user))
+        # Gravatar can't have an avatar for users without an email
+        self.user.email = ""
+        self.assertEqual(resolve_avatar_url(self.user), get_default_avatar_url())
+        self.assertEqual(
+            get_avatar_urls([self.user], 40), {self.user.pk: get_default_avatar_url()}
+        )
+        stats = get_provider_stats()
+        self.assertEqual(stats["avatar.providers.GravatarAvatarProvider"]["calls"], 1)
+        self.assertEqual(stats["avatar.providers.GravatarAvatarProvider"]["skips"], 2)
+        self.assertEqual(stats["avatar.providers.DefaultAvatarProvider"]["calls"], 2)
+        with override_settings(
+            AVATAR_PROVIDERS=("avatar.providers.DefaultAvatarProvider",)
+        ):
+            self.assertEqual(len(get_providers()), 1)
+        self.assertEqual(len(get_providers()), 2)
+
+    @override_settings(
+        AVATAR_RENDER_PRIMARY_MODE="stream",
+        AVATAR_THUMBNAIL_TASK_BACKEND="avatar.tasks.DatabaseBackend",
+    )
+    def test_render_primary_stream_pending(self):
+        upload_helper(self, "test.png")
+        avatar = Avatar.objects.get(user=self.user)
+        url = reverse("avatar:render_primary", args=[self.user.pk, 80])
+        response = self.client.get(url)
+        with avatar.avatar.storage.open(avatar.avatar.name, "rb") as f:
+            self.assertEqual(b"".join(response.streaming_content), f.read())
+        # The original stands in for the thumbnail, don't keep it around
+        self.assertEqual(response["Cache-Control"], "no-cache")
+
+        management.call_command("process_avatar_thumbnails", verbosity=0)
+        response = self.client.get(url)
+        self.assertIn("immutable", response["Cache-Control"])
+
+    @override_settings(AVATAR_RENDER_PRIMARY_MODE="stream")
+    def test_render_primary_stream(self):
+        url = reverse("avatar:render_primary", args=[self.user.pk, 80])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, get_default_avatar_url())
+
+        upload_helper(self, "test.png")
+        avatar = Avatar.objects.get(user=self.user)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        with avatar.avatar.storage.open(avatar.avatar_name(80), "rb") as f:
+            self.assertEqual(b"".join(response.streaming_content), f.read())
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertIn("immutable", response["Cache-Control"])
+        self.assertIn("Last-Modified", response)
+        etag = response["ETag"]
+
+        # Revalidations are answered from the cache
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+        # Each size has its own ETag
+        response = self.client.get(
+            reverse("avatar:render_primary", args=[self.user.username, 60, 110])
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+        # Changing the avatar changes the ETag
+        upload_helper(self, "django.png")
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    @override_settings(
+        AVATAR_RENDER_PRIMARY_MODE="stream",
+        AVATAR_SENDFILE_BACKEND="x-accel-redirect",
+        AVATAR_SENDFILE_URL_PREFIX="/internal/media",
+    )
+    def test_render_primary_x_accel_redirect(self):
+        upload_helper(self, "test.png")
+        avatar = Avatar.objects.get(user=self.user)
+        response = self.client.get(
+            reverse("avatar:render_primary", args=[self.user.pk, 80])
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response["X-Accel-Redirect"], "/internal/media/" + avatar.avatar_name(80)
+        )
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertEqual(response.content, b"")
+        self.assertIn("ETag", response)
+
+    @override_settings(
+        AVATAR_RENDER_PRIMARY_MODE="stream", AVATAR_SENDFILE_BACKEND="x-sendfile"
+    )
+    def test_render_primary_x_sendfile(self):
+        upload_helper(self, "test.png")
+        avatar = Avatar.objects.get(user=self.user)
+        response = self.client.get(
+            reverse("avatar:render_primary", args=[self.user.pk, 80])
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response["X-Sendfile"], avatar.avatar.storage.path(avatar.avatar_name(80))
+        )
+        self.assertEqual(response.content, b"")
+
+    @override_settings(
+        AVATAR_NORMALIZE_ORIGINALS=True, AVATAR_MAX_ORIGINAL_DIMENSION=70
+    )
+    def test_normalize_originals(self):
+        upload_helper(self, "test.png")
+        avatar = Avatar.objects.get(user=self.user)
+        self.assertTrue(avatar.avatar.name.endswith(".jpg"))
+        with avatar.avatar.storage.open(avatar.avatar.name, "rb") as f:
+            image = Image.open(f)
+            self.assertEqual(image.format, "JPEG")
+            self.assertEqual(image.size, (70, 40))
+            self.assertEqual(image.mode, "RGB")
+        self.assertTrue(avatar.thumbnail_exists(80))
+
+    @override_settings(AVATAR_NORMALIZE_ORIGINALS=True)
+    def test_normalize_originals_orientation_and_metadata(self):
+        upload_helper(self, "image_exif_orientation.jpg")
+        avatar = Avatar.objects.get(user=self.user)
+        with avatar.avatar.storage.open(avatar.avatar.name, "rb") as f:
+            image = Image.open(f)
+            self.assertNotIn("exif", image.info)
+            self.assertNotIn("xmp", image.info)
+            image_no_exif = Image.open(
+                os.path.join(self.testdatapath, "image_no_exif.jpg")
+            )
+            self.assertLess(root_mean_square_difference(image, image_no_exif), 5)
+
+    @override_settings(AVATAR_NORMALIZE_ORIGINALS=True)
+    def test_normalize_originals_keeps_transparency(self):
+        upload_helper(self, "django.png")
+        avatar = Avatar.objects.get(user=self.user)
+        self.assertTrue(avatar.avatar.name.endswith(".png"))
+        with avatar.avatar.storage.open(avatar.avatar.name, "rb") as f:
+            self.assertEqual(Image.open(f).mode, "RGBA")
+
+    @override_settings(AVATAR_NORMALIZE_ORIGINALS=True)
+    def test_normalize_originals_colour_mode(self):
+        upload_helper(self, "django_pony_cmyk.jpg")
+        avatar = Avatar.objects.get(user=self.user)
+        with avatar.avatar.storage.open(avatar.avatar.name, "rb") as f:
+            self.assertEqual(Image.open(f).mode, "RGB")
+
+    @override_settings(AVATAR_NORMALIZE_ORIGINALS=True)
+    def test_normalize_originals_converts_to_srgb(self):
+        # A profile with the red and blue primaries swapped
+        profile = rgb_icc_profile(
+            (0.1431, 0.0606, 0.7141), (0.3851, 0.7169, 0.0971), (0.4361, 0.2225, 0.0139)
+        )
+        data = BytesIO()
+        Image.new("RGB", (100, 100), (255, 0, 0)).save(
+            data, "JPEG", icc_profile=profile
+        )
+        avatar = Avatar(user=self.user, primary=True)
+        avatar.avatar.save("wide.jpg", SimpleUploadedFile("wide.jpg", data.getvalue()))
+        with avatar.avatar.storage.open(avatar.avatar.name, "rb") as f:
+            image = Image.open(f)
+            self.assertIsNone(image.info.get("icc_profile"))
+            red, green, blue = image.getpixel((50, 50))
+        self.assertLess(red, 50)
+        self.assertGreater(blue, 200)
+
+    @override_settings(AVATAR_NORMALIZE_ORIGINALS=True)
+    def test_normalize_originals_keeps_unusable_profile(self):
+        data = BytesIO()
+        Image.new("RGB", (100, 100), (255, 0, 0)).save(
+            data, "JPEG", icc_profile=b"not a profile"
+        )
+        avatar = Avatar(user=self.user, primary=True)
+        avatar.avatar.save("bad.jpg", SimpleUploadedFile("bad.jpg", data.getvalue()))
+        with avatar.avatar.storage.open(avatar.avatar.name, "rb") as f:
+            self.assertEqual(Image.open(f).info.get("icc_profile"), b"not a profile")
+
+    @override_settings(AVATAR_MAX_PIXELS=100 * 100)
+    def test_upload_too_many_pixels(self):
+        response = upload_helper(self, "test.png")
+        self.assertEqual(len(response.redirect_chain), 0)
+        self.assertIn(
+            "Your image is too large (700x400 pixels)",
+            response.context["upload_avatar_form"].errors["avatar"][0],
+        )
+        self.assertFalse(Avatar.objects.exists())
+
+    @override_settings(
+        AVATAR_ALLOWED_MIMETYPES=("image/png",), AVATAR_MAX_AVATARS_PER_USER=1
+    )
+    def test_upload_validation_does_not_decode(self):
+        with open(os.path.join(self.testdatapath, "test.png"), "rb") as f:
+            upload = SimpleUploadedFile("test.png", f.read())
+        form = UploadAvatarForm(files={"avatar": upload}, user=self.user)
+        with patch.object(ImageFile.ImageFile, "load") as load:
+            with self.assertNumQueries(0):
+                self.assertTrue(form.is_valid())
+        load.assert_not_called()
+
+    @override_settings(AVATAR_THUMB_EXTRA_FORMATS=("AVIF", "WEBP"))
+    def test_thumbnail_extra_formats(self):
+        upload_helper(self, "test.png")
+        avatar = Avatar.objects.get(user=self.user)
+        storage = avatar.avatar.storage
+        for format in ("PNG", "AVIF", "WEBP"):
+            name = avatar.avatar_name(80, format=format)
+            self.assertTrue(name.endswith("." + format.lower()))
+            self.assertTrue(avatar.thumbnail_exists(80, format=format))
+            with storage.open(name, "rb") as f:
+                image = Image.open(f)
+                self.assertEqual((image.format, image.size), (format, (80, 80)))
+
+        url = reverse("avatar:render_primary", args=[self.user.pk, 80])
+        for accept, format in (
+            ("image/avif,image/webp,*/*", "AVIF"),
+            ("image/webp,*/*", "WEBP"),
+            ("image/*,*/*;q=0.8", "PNG"),
+            ("image/avif;q=0,image/webp,*/*", "WEBP"),
+            ("image/avif; q=0.0, image/webp;q=0,*/*", "PNG"),
+        ):
+            response = self.client.get(url, HTTP_ACCEPT=accept)
+            self.assertEqual(response.url, avatar.avatar_url(80, format=format))
+            self.assertIn("Accept", response["Vary"])
+        with override_settings(AVATAR_RENDER_PRIMARY_MODE="stream"):
+            response = self.client.get(url, HTTP_ACCEPT="image/webp,*/*")
+            self.assertEqual(response["Content-Type"], "image/webp")
+            self.assertIn("Accept", response["Vary"])
+
+        result = avatar_tags.avatar_picture(self.user, 80)
+        self.assertInHTML(
+            '<source srcset="%s" type="image/avif" />'
+            % avatar.avatar_url(80, format="AVIF"),
+            result,
+        )
+        self.assertInHTML(
+            '<source srcset="%s" type="image/webp" />'
+            % avatar.avatar_url(80, format="WEBP"),
+            result,
+        )
+        self.assertInHTML(avatar_tags.avatar(self.user, 80), result)
+
+        avatar.delete()
+        for format in ("PNG", "AVIF", "WEBP"):
+            self.assertFalse(storage.exists(avatar.avatar_name(80, format=format)))
+
+    @override_settings(AVATAR_ALLOWED_SIZES=(40, 80, (60, 40), 160))
+    def test_snap_size(self):
+        self.assertEqual(snap_size(80), (80, 80))
+        self.assertEqual(snap_size(50), (80, 80))
+        self.assertEqual(snap_size(30, 20), (60, 40))
+        self.assertEqual(snap_size(70, 30), (80, 80))
+        self.assertEqual(snap_size(500), (160, 160))
+        with override_settings(AVATAR_ALLOWED_SIZES=None):
+            self.assertEqual(snap_size(50), (50, 50))
+
+    @override_settings(AVATAR_ALLOWED_SIZES=(40, 80))
+    def test_allowed_sizes(self):
+        upload_helper(self, "test.png")
+        avatar = Avatar.objects.get(user=self.user)
+        result = avatar_tags.avatar(self.user, 50)
+        self.assertInHTML(
+            '<img src="%s" width="50" height="50" alt="User Avatar" />'
+            % avatar.avatar_url(80),
+            result,
+        )
+        self.assertEqual(avatar.avatar_url(50), avatar.avatar_url(80))
+        self.assertFalse(
+            avatar.thumbnails.filter(width__in=[50, 62, 51]).exists(),
+        )
+        response = self.client.get(
+            reverse("avatar:render_primary", args=[self.user.pk, 50])
+        )
+        self.assertEqual(response.url, avatar.avatar_url(80))
+        with override_settings(AVATAR_SIZE_POLICY="reject"):
+            response = self.client.get(
+                reverse("avatar:render_primary", args=[self.user.pk, 50])
+            )
+            self.assertEqual(response.status_code, 404)
+            response = self.client.get(
+                reverse("avatar:render_primary", args=[self.user.pk, 40])
+            )
+            self.assertEqual(response.url, avatar.avatar_url(40))
+
+    @override_settings(AVATAR_THUMBNAIL_LOCK_WAIT=0)
+    def test_create_thumbnail_once_concurrent(self):
+        upload_helper(self, "test.png")
+        avatar = Avatar.objects.select_related("user").get(user=self.user)
+        # Threads can't query the database of the test
+        avatar.thumbnail_manifest
+        calls = []
+
+        def create_thumbnails(sizes, quality=None, formats=None):
+            calls.append(sizes)
+            time.sleep(0.2)
+
+        results = []
+        with patch.object(avatar, "create_thumbnails", create_thumbnails):
+            threads = [
+                threading.Thread(
+                    target=lambda: results.append(create_thumbnail_once(avatar, 100))
+                )
+                for _ in range(8)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(calls, [[(100, 100)]])
+        self.assertEqual(sorted(results), [False] * 7 + [True])
+
+    @override_settings(AVATAR_THUMBNAIL_LOCK_WAIT=0.1)
+    def test_create_thumbnail_once_waits_for_lock(self):
+        upload_helper(self, "test.png")
+        avatar = Avatar.objects.get(user=self.user)
+        lock_key = get_cache_key("avatar_%s" % avatar.pk, "thumbnail_lock", 100, 100)
+        cache.add(lock_key, 1)
+        with patch.object(avatar, "create_thumbnails") as create_thumbnails:
+            start = time.monotonic()
+            self.assertFalse(create_thumbnail_once(avatar, 100))
+            self.assertGreaterEqual(time.monotonic() - start, 0.1)
+            # Served the original while the other request creates it
+            self.assertEqual(
+                PrimaryAvatarProvider.get_url(avatar, 100, 100), avatar.avatar.url
+            )
+        create_thumbnails.assert_not_called()
+        cache.delete(lock_key)
+        self.assertTrue(create_thumbnail_once(avatar, 100))
+        self.assertEqual(
+            PrimaryAvatarProvider.get_url(avatar, 100, 100), avatar.avatar_url(100)
+        )
+
+
+class MigrationTests(TransactionTestCase):
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def test_keep_latest_primary(self):
+        apps = self.migrate([("avatar", "0006_avatar_placeholder")])
+        User = apps.get_model(settings.AUTH_USER_MODEL)
+        HistoricalAvatar = apps.get_model("avatar", "Avatar")
+        user = User.objects.create(username="test")
+        other = User.objects.create(username="other")
+        uploaded = timezone.now()
+        older = HistoricalAvatar.objects.create(
+            user=user,
+            primary=True,
+            avatar="older.png",
+            date_uploaded=uploaded - timedelta(days=1),
+        )
+        newer = HistoricalAvatar.objects.create(
+            user=user, primary=True, avatar="newer.png", date_uploaded=uploaded
+        )
+        alone = HistoricalAvatar.objects.create(
+            user=other, primary=True, avatar="alone.png", date_uploaded=uploaded
+        )
+
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+        self.assertEqual(
+            dict(Avatar.objects.values_list("pk", "primary")),
+            {older.pk: False, newer.pk: True, alone.pk: True},
+        )